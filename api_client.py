@@ -6,6 +6,7 @@ GrsAI API客户端
 import json
 import time
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Optional, Dict, Any, List, Tuple, TYPE_CHECKING
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
@@ -57,6 +58,12 @@ class GrsaiAPI:
         # 直接使用传入的API密钥设置认证头
         self.session.headers["Authorization"] = f"Bearer {self.api_key}"
 
+        # 同一客户端会被多个线程共用，连接池需容纳全部并发请求，否则多出的连接用完即关闭、下次重新握手
+        pool_maxsize = self.config.get_config("http_pool_maxsize", 32)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
     def _make_request(
         self,
         method: str,
@@ -21,6 +21,7 @@ class GrsaiConfig:
             "timeout": 300,
             "max_retries": 3,
             "model": "nano-banana-fast",
+            "http_pool_maxsize": 32,  # 每个客户端连接池保留的最大连接数，应不小于同时使用该客户端的线程数
         }
         self._api_key = os.getenv("GRSAI_API_KEY", "")
         self.api_key_error_message = (
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+测试元数据快照：保存后模拟重启恢复，画廊应显示全部恢复的输出
+"""
+
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("PIL")
+pytest.importorskip("gradio")
+
+import webui
+
+
+def test_snapshot_round_trip_restores_full_gallery(tmp_path, monkeypatch):
+    """快照往返后画廊条数与恢复的输出数一致"""
+    monkeypatch.setattr(webui, "METADATA_SNAPSHOT_PATH", str(tmp_path / "snapshot.json.gz"))
+    
+    output_files = []
+    for i in range(5):
+        output_file = tmp_path / f"Task_{i}_1.png"
+        output_file.write_bytes(b"")
+        output_files.append(str(output_file))
+        webui._append_output_file(str(output_file), webui.ImageMetadata(
+            prompt=f"提示词{i}", model="nano-banana", aspect_ratio="1:1",
+            upload_time=0.5, api_time=1.5, task_name=f"Task_{i}", retry_attempts=1
+        ))
+    webui.save_metadata_snapshot()
+    
+    # 模拟重启：清空输出，并让画廊缓存与当前版本号同步
+    webui.clear_all_outputs()
+    _, gallery_images, _ = webui._build_current_status()
+    assert not gallery_images
+    
+    assert webui.load_metadata_snapshot() == 5
+    _, gallery_images, _ = webui._build_current_status()
+    assert [file_path for file_path, _ in gallery_images] == output_files
+    assert webui._get_image_metadata(output_files[0]).prompt == "提示词0"
@@ -6,6 +6,7 @@ GrsAI文件上传模块
 
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import mimetypes
 from typing import Optional, Dict, Any
 from pathlib import Path
@@ -16,6 +17,14 @@ class UploadError(Exception):
     pass
 
 
+# 所有上传共用一个会话：复用连接池和TLS连接，避免每次请求都重新握手
+# 所有任务组的上传线程共用该会话，连接池按最大并发放大（requests 默认每个主机只保留10个连接）
+UPLOAD_POOL_MAXSIZE = 64
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=UPLOAD_POOL_MAXSIZE))
+_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=UPLOAD_POOL_MAXSIZE))
+
+
 def get_upload_token_zh(api_key: str, params: Optional[Dict] = None) -> Optional[Dict[str, Any]]:
     """
     获取上传token（国内加速版本）
@@ -48,7 +57,7 @@ def get_upload_token_zh(api_key: str, params: Optional[Dict] = None) -> Optional
     payload = params or {}
     
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+        response = _session.post(url, json=payload, headers=headers, timeout=30)
         response.raise_for_status()
         
         result = response.json()
@@ -85,7 +94,7 @@ def upload_to_cdn(file_path: str, token: str, key: str, upload_url: str) -> bool
                 'key': key
             }
             
-            response = requests.post(
+            response = _session.post(
                 upload_url,
                 data=data,
                 files=files,
@@ -4,8 +4,18 @@
 
 import io
 import requests
-from typing import Optional
-from PIL import Image
+from requests.adapters import HTTPAdapter
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+
+# 结果图像下载共用一个会话，复用到CDN的连接，避免每张图都重新握手
+DOWNLOAD_POOL_MAXSIZE = 32
+_download_session = requests.Session()
+_download_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=DOWNLOAD_POOL_MAXSIZE))
+_download_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=DOWNLOAD_POOL_MAXSIZE))
 
 
 def format_error_message(error: Exception, context: str = "") -> str:
@@ -24,7 +34,7 @@ def format_error_message(error: Exception, context: str = "") -> str:
     return str(error)
 
 
-def download_image(url: str, timeout: int = 120) -> Optional[Image.Image]:
+def download_image(url: str, timeout: int = 120) -> Optional["Image.Image"]:
     """
     从URL下载图像
     
@@ -35,8 +45,10 @@ def download_image(url: str, timeout: int = 120) -> Optional[Image.Image]:
     Returns:
         PIL图像对象，失败返回None
     """
+    from PIL import Image  # 首次下载时才加载 PIL，不拖慢启动
+    
     try:
-        response = requests.get(url, timeout=timeout)
+        response = _download_session.get(url, timeout=timeout)
         response.raise_for_status()
         image = Image.open(io.BytesIO(response.content))
         return image
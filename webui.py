@@ -12,14 +12,22 @@ Banana 图像生成 WebUI
 import os
 import sys
 import time
+import math
+import gzip
+import json
+import hashlib
+import random
+import queue
+import atexit
 import gradio as gr
 from pathlib import Path
 from typing import List, Tuple, Optional
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor
 import traceback
 import threading
-import uuid
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
+from functools import lru_cache
+from itertools import count, cycle, islice
 
 # 保证可从当前目录导入
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -41,70 +49,574 @@ except ImportError as e:
 DEFAULT_API_KEY = os.getenv("GRSAI_API_KEY", "")
 DEFAULT_BACKUP_KEYS = os.getenv("GRSAI_BACKUP_KEYS", "")
 OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "batch_outputs")
-SUPPORTED_IMAGE_FORMATS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif"}
+# 允许页面直接访问的目录（输出目录及缩略图、旧版 outputs 目录），导入时规范化并去重一次
+ALLOWED_PATHS = list(dict.fromkeys(
+    os.path.realpath(path) for path in (OUTPUT_DIR, os.path.join(os.path.dirname(__file__), "outputs"))
+))
+SUPPORTED_IMAGE_FORMATS = frozenset({".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif"})
+# 画廊及图像元数据保留的最近输出数量，可通过 GRSAI_MAX_OUTPUTS 调整
+try:
+    MAX_GALLERY_OUTPUTS = max(1, int(os.getenv("GRSAI_MAX_OUTPUTS", "200")))
+except ValueError:
+    MAX_GALLERY_OUTPUTS = 200
+# 输出PNG的zlib压缩级别（0-9），默认1：编码快得多，文件略大；可通过 GRSAI_PNG_COMPRESS_LEVEL 调整
+try:
+    PNG_COMPRESS_LEVEL = min(9, max(0, int(os.getenv("GRSAI_PNG_COMPRESS_LEVEL", "1"))))
+except ValueError:
+    PNG_COMPRESS_LEVEL = 1
+# WebUI 监听端口，可通过 GRSAI_WEBUI_PORT 调整（默认7861）
+try:
+    WEBUI_PORT = int(os.getenv("GRSAI_WEBUI_PORT", "7861"))
+except ValueError:
+    WEBUI_PORT = 7861
+# 调试模式：任务异常时额外打印完整堆栈，可通过 GRSAI_DEBUG 开启
+DEBUG = bool(os.getenv("GRSAI_DEBUG"))
 
 # 全局状态管理
-task_groups = defaultdict(dict)  # {group_id: {upload_progress, api_progress, status, results}}
-task_groups_lock = threading.Lock()
-all_output_files = []  # 所有任务组的输出文件累计 [(file_path, metadata)]
+task_groups = defaultdict(dict)  # {group_id: {upload_progress, api_progress, status, log, lock}}，lock 保护该组自身的字段
+task_groups_lock = threading.Lock()  # 只保护任务组的登记、淘汰和清空，更新字段用各组自己的锁
+task_groups_version = 0  # 任务组状态版本号，任何字段变化时更新为新的唯一值
+_task_groups_versions = count(1)  # 版本号来源：next() 原子取号，不同任务组并发更新也不会得到相同的版本号
+MAX_TASK_GROUPS = 64  # 保留的任务组状态数量，超出后淘汰最早的已结束任务组
+MAX_LOG_LINES = 50  # 每个任务组保留的日志行数
+MAX_LOG_TEXT_CHARS = 4096  # 日志框每次推送的最大字符数
+recent_groups = deque(maxlen=3)  # 最近提交的任务组 [(group_id, info)]，供状态轮询直接读取
+all_output_files = deque(maxlen=MAX_GALLERY_OUTPUTS)  # 最近的输出文件 [(file_path, metadata)]，超出上限时淘汰最早的
 all_output_files_lock = threading.Lock()
-image_metadata = {}  # {output_path: {source_image, prompt, model, aspect_ratio, ...}}
+all_output_version = 0  # 输出列表版本号，追加或清空时递增
+_pending_outputs = queue.SimpleQueue()  # 生成线程只入队不加锁，读取前由 _drain_pending_outputs 合并进 all_output_files
+_gallery_cache = {'version': 0, 'items': deque(maxlen=MAX_GALLERY_OUTPUTS), 'value': None}  # items/value 为 (图像路径, 标题)
+_gallery_cache_lock = threading.Lock()  # 保护画廊缓存；需要同时持有时先取本锁再取 all_output_files_lock
+_status_cache = {'entry': (None, None)}  # (版本号, 状态结果)，无变化时直接复用
+image_metadata = OrderedDict()  # {output_path: ImageMetadata}，按最近使用排序，最多 MAX_GALLERY_OUTPUTS 条
 image_metadata_lock = threading.Lock()
+MAX_PROMPT_POOL = 1024  # 提示词共享表上限，超出后清空重建
+_prompt_pool = {}  # {prompt: prompt}，让相同提示词的元数据共享一个字符串对象
+
+# 输出列表及元数据快照：重启后恢复画廊和重做/查看信息
+# 保存为 gzip 压缩的 JSON，放在程序目录而不是输出目录（输出目录可通过页面直接访问）
+METADATA_SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".webui_metadata.json.gz")
+METADATA_SNAPSHOT_INTERVAL = 60  # 定时快照间隔（秒）
+METADATA_SNAPSHOT_EVERY = 20  # 新增这么多输出后提前快照
+_metadata_snapshot_version = 0  # 最近一次写入快照时的 all_output_version
+_metadata_snapshot_lock = threading.Lock()
+_metadata_snapshot_event = threading.Event()
 
 # 任务中止控制
-task_group_cancel_flags = {}
-task_group_cancel_lock = threading.Lock()
+task_group_cancel_events = {}  # {group_id: threading.Event}，已提交且未结束的任务组，事件置位表示已请求中止
+task_group_cancel_lock = threading.Lock()  # 只保护登记和移除，读取和置位不加锁
 
 # URL缓存：避免重复上传相同图像
-upload_cache = {}  # {file_path: cdn_url}
+MAX_UPLOAD_CACHE = 4096  # URL缓存最多保留的文件数，超出后淘汰最久未使用的
+upload_cache = OrderedDict()  # {(文件大小, 内容摘要): cdn_url}，按内容而非路径缓存
 upload_cache_lock = threading.Lock()
+_upload_inflight = {}  # {(文件大小, 内容摘要): threading.Event}，正在上传的文件，同一内容只上传一次
+_file_digest_cache = {}  # {file_path: ((文件大小, 修改时间ns), 缓存键)}，文件未变化时不重复计算摘要
+_file_digest_lock = threading.Lock()
+
+
+# API客户端按密钥复用：每个客户端持有一个 requests.Session，复用连接池和TLS连接
+MAX_API_CLIENTS = 32
+_api_clients = {}  # {api_key: GrsaiAPI}
+_api_clients_lock = threading.Lock()
+
 
+def get_api_client(api_key: str) -> GrsaiAPI:
+    """获取该密钥共用的API客户端，首次使用时创建"""
+    client = _api_clients.get(api_key)
+    if client is None:
+        with _api_clients_lock:
+            client = _api_clients.get(api_key)
+            if client is None:
+                if len(_api_clients) >= MAX_API_CLIENTS:
+                    _api_clients.clear()  # 仍在使用的客户端由调用方持有引用，不受影响
+                client = _api_clients[api_key] = GrsaiAPI(api_key=api_key)
+    return client
 
-def get_api_key_for_task(task_id: int, all_keys: List[str]) -> str:
-    """为任务分配API密钥（轮询分配）"""
+
+def cycle_api_keys(all_keys: List[str]):
+    """按任务顺序轮询分配API密钥，与任务列表 zip 使用
+    
+    起始密钥随机选取：任务数不是密钥数的整数倍时，多出的任务不会总落在主密钥上，并发的任务组之间也更均衡。
+    """
     if not all_keys:
         raise ValueError("没有可用的API密钥")
-    key_index = (task_id - 1) % len(all_keys)
-    return all_keys[key_index]
+    start = random.randrange(len(all_keys))
+    return cycle(all_keys[start:] + all_keys[:start])
 
 
 def register_task_group_for_cancel(group_id: str):
     """注册任务组以支持中止控制"""
     with task_group_cancel_lock:
-        task_group_cancel_flags[group_id] = False
+        task_group_cancel_events[group_id] = threading.Event()
 
 
 def clear_task_group_cancel_flag(group_id: str):
     """任务结束后清理中止标记"""
     with task_group_cancel_lock:
-        task_group_cancel_flags.pop(group_id, None)
+        task_group_cancel_events.pop(group_id, None)
 
 
-def is_task_group_cancelled(group_id: str) -> bool:
-    """检测任务组是否已请求中止"""
-    with task_group_cancel_lock:
-        return task_group_cancel_flags.get(group_id, False)
+def get_task_group_cancel_event(group_id: str) -> threading.Event:
+    """取得任务组的中止事件，任务组开始时取一次存为局部变量，之后检查中止只需 is_set()，不再查字典"""
+    event = task_group_cancel_events.get(group_id)
+    return event if event is not None else threading.Event()  # 未登记的任务组不会被中止
 
 
 def request_cancel_all_tasks() -> List[str]:
     """标记所有任务组为已请求中止，返回受影响的任务组ID列表"""
     with task_group_cancel_lock:
-        targets = list(task_group_cancel_flags.keys())
-        for gid in targets:
-            task_group_cancel_flags[gid] = True
+        targets = list(task_group_cancel_events.items())
+    for _, event in targets:
+        event.set()
+    targets = [gid for gid, _ in targets]
     if not targets:
         return []
 
-    with task_groups_lock:
-        for gid in targets:
-            if gid in task_groups:
-                logs = task_groups[gid].get('log', [])
-                logs.append("⛔ 用户请求中止任务")
-                task_groups[gid]['log'] = logs
-                task_groups[gid]['status'] = "⛔ 已请求中止"
+    for gid in targets:
+        update_task_group(gid, log_line="⛔ 用户请求中止任务", status="⛔ 已请求中止")
     return targets
 
 
+# 任务组调度：常驻守护线程消费提交队列，避免每次提交都新建线程
+MAX_DISPATCH_WORKERS = 16
+_dispatch_deque = deque()  # [(fn, args)]
+_dispatch_cond = threading.Condition()
+_dispatch_idle_workers = 0  # 正在等待且尚未被唤醒的工作线程数
+_dispatch_waking_workers = 0  # 已唤醒/新建但尚未取到任务的工作线程数
+_dispatch_worker_count = 0
+
+
+def _wake_dispatch_workers_locked():
+    """按积压数量一次性唤醒或新建工作线程（调用方需持有 _dispatch_cond）"""
+    global _dispatch_idle_workers, _dispatch_waking_workers, _dispatch_worker_count
+    need = len(_dispatch_deque) - _dispatch_waking_workers
+    if need <= 0:
+        return
+    woken = min(need, _dispatch_idle_workers)
+    if woken:
+        _dispatch_idle_workers -= woken
+        _dispatch_waking_workers += woken
+        _dispatch_cond.notify(woken)
+    for _ in range(need - woken):
+        if _dispatch_worker_count >= MAX_DISPATCH_WORKERS:
+            break
+        _dispatch_worker_count += 1
+        _dispatch_waking_workers += 1
+        threading.Thread(
+            target=_dispatch_worker,
+            name=f"task-group-{_dispatch_worker_count}",
+            daemon=True
+        ).start()
+
+
+def _dispatch_worker():
+    """常驻工作线程：循环取出并执行已提交的任务组"""
+    global _dispatch_idle_workers, _dispatch_waking_workers
+    signaled = True  # 新建的线程视同已被唤醒
+    while True:
+        with _dispatch_cond:
+            if signaled:
+                _dispatch_waking_workers -= 1
+            while not _dispatch_deque:
+                _dispatch_idle_workers += 1
+                _dispatch_cond.wait()
+                _dispatch_waking_workers -= 1
+            signaled = False
+            fn, args = _dispatch_deque.popleft()
+            # 突发提交时由首个被唤醒的线程为剩余积压统一分配线程
+            if _dispatch_deque:
+                _wake_dispatch_workers_locked()
+        try:
+            fn(*args)
+        except Exception:
+            traceback.print_exc()
+
+
+def submit_task_group(fn, *args):
+    """提交任务组到常驻线程池后台执行"""
+    with _dispatch_cond:
+        _dispatch_deque.append((fn, args))
+        # 仅在队列由空变为非空时唤醒，连续提交只做入队
+        if len(_dispatch_deque) == 1:
+            _wake_dispatch_workers_locked()
+
+
+def _ensure_output_dir(output_dir):
+    """确保输出目录存在（每次都检查：运行期间目录被删除后会重新创建）"""
+    os.makedirs(output_dir, exist_ok=True)
+
+
+_last_group_id_ms = 0
+_group_id_lock = threading.Lock()
+
+
+def new_task_group_id() -> str:
+    """
+    生成8位十六进制任务组ID
+    
+    以毫秒时间为基准单调递增，在一次进程运行内唯一；只保留低32位，约49.7天回绕一次，
+    跨重启不保证与之前的输出文件名（Task_{group_id[:8]}_...）不重名
+    """
+    global _last_group_id_ms
+    with _group_id_lock:
+        _last_group_id_ms = max(int(time.time() * 1000), _last_group_id_ms + 1)
+        return f"{_last_group_id_ms & 0xFFFFFFFF:08x}"
+
+
+def _init_task_group(group_id, info):
+    """登记任务组状态"""
+    global task_groups_version
+    info['lock'] = threading.Lock()
+    if 'log' not in info:
+        info['log'] = deque(maxlen=MAX_LOG_LINES)
+    with task_groups_lock:
+        task_groups[group_id] = info
+        recent_groups.append((group_id, info))
+        task_groups_version = next(_task_groups_versions)
+        # 状态显示只用 recent_groups，已结束的旧任务组不再需要保留
+        excess = len(task_groups) - MAX_TASK_GROUPS
+        if excess > 0:
+            finished = [gid for gid in task_groups if gid not in task_group_cancel_events]
+            for gid in finished[:excess]:
+                del task_groups[gid]
+
+
+def update_task_group(group_id, log_line=None, log_lines=None, **fields):
+    """更新任务组状态字段，可选追加日志（单行或多行）；任务组已被清空时忽略"""
+    global task_groups_version
+    info = task_groups.get(group_id)  # 查找不加全局锁，只在该组自己的锁内修改
+    if info is None:
+        return
+    with info['lock']:
+        info.update(fields)
+        # 日志 deque 在登记时创建一次，之后只原地追加，不重新分配或复制
+        log = info['log']
+        if log_lines:
+            log.extend(log_lines)
+        if log_line is not None:
+            log.append(log_line)
+    task_groups_version = next(_task_groups_versions)
+
+
+def _task_group_snapshot(info, with_log=False):
+    """在该组的锁内一次取出 (状态, 上传进度, API进度, 日志)"""
+    with info['lock']:
+        return (
+            info['status'],
+            info['upload_progress'],
+            info['api_progress'],
+            tuple(info['log']) if with_log else ()
+        )
+
+
+# 任务完成时的进度/日志批量写入：距上次写入超过该间隔才写一次（状态轮询每2秒一次，更频繁的写入不会被看到）
+TASK_GROUP_FLUSH_INTERVAL = 0.25  # 秒
+
+
+class TaskGroupReporter:
+    """任务组进度上报：日志和进度先在工作线程本地累积，批量写入共享状态，减少锁竞争"""
+    
+    def __init__(self, group_id: str):
+        self.group_id = group_id
+        self.pending_lines = []
+        self.pending_fields = {}
+        self.last_flush = time.monotonic()
+    
+    def log(self, line: str):
+        """追加一行日志（下次写入时一并提交）"""
+        self.pending_lines.append(line)
+    
+    def progress(self, **fields):
+        """记录一批任务完成后的进度，距上次写入超过间隔时间才写入"""
+        self.pending_fields.update(fields)
+        if time.monotonic() - self.last_flush >= TASK_GROUP_FLUSH_INTERVAL:
+            self.flush()
+    
+    def flush_pending(self):
+        """有尚未写入的日志或进度时立即写入（等待任务完成的空闲期间调用，避免最后一批进度迟迟不显示）"""
+        if self.pending_lines or self.pending_fields:
+            self.flush()
+    
+    def aborted(self, line: str):
+        """记录中止原因并一次写入中止状态（日志和状态在同一次加锁内提交）"""
+        self.pending_lines.append(line)
+        self.flush(status="⛔ 用户已中止")
+    
+    def flush(self, **fields):
+        """立即写入累积的日志、进度以及本次给出的字段（状态变化时调用）"""
+        self.pending_fields.update(fields)
+        update_task_group(self.group_id, log_lines=self.pending_lines, **self.pending_fields)
+        self.pending_lines = []
+        self.pending_fields = {}
+        self.last_flush = time.monotonic()
+
+
+class ImageMetadata:
+    """单张输出图像的元数据（使用 __slots__，每条记录不再附带一个字典）"""
+    
+    __slots__ = (
+        'mode', 'source_image', 'source_images', 'prompt', 'model', 'aspect_ratio',
+        'upload_time', 'api_time', 'task_name', 'cdn_url', 'cdn_urls', 'retry_attempts',
+        'prompt_history', 'stage_index', 'replace_prompt', 'rendered_info'
+    )
+    
+    def __init__(self, prompt: str, model: str, aspect_ratio: str, upload_time: float, api_time: float,
+                 task_name: str, retry_attempts: int, mode: str = 'single',
+                 source_image: Optional[str] = None, source_images: Tuple[str, ...] = (),
+                 cdn_url: Optional[str] = None, cdn_urls: Tuple[str, ...] = (),
+                 prompt_history: Tuple[str, ...] = (), stage_index: Optional[int] = None,
+                 replace_prompt: bool = False):
+        self.mode = mode
+        self.source_image = source_image  # 单图模式的源图像
+        self.source_images = source_images  # 多图/分阶段模式的源图像
+        self.prompt = prompt
+        self.model = sys.intern(model)
+        self.aspect_ratio = sys.intern(aspect_ratio)
+        self.upload_time = upload_time
+        self.api_time = api_time
+        self.task_name = task_name
+        self.cdn_url = cdn_url
+        self.cdn_urls = cdn_urls
+        self.retry_attempts = retry_attempts
+        self.prompt_history = prompt_history
+        self.stage_index = stage_index
+        self.replace_prompt = replace_prompt
+        self.rendered_info = None  # 详情文本缓存，首次查看时生成
+    
+    def to_dict(self) -> dict:
+        """写入快照用的纯数据字典（不含详情文本缓存）"""
+        return {name: getattr(self, name) for name in _METADATA_SNAPSHOT_FIELDS}
+    
+    @classmethod
+    def from_dict(cls, data: dict) -> "ImageMetadata":
+        """从快照字典重建元数据（JSON 中的列表还原为元组）"""
+        return cls(
+            prompt=data['prompt'],
+            model=data['model'],
+            aspect_ratio=data['aspect_ratio'],
+            upload_time=float(data['upload_time']),
+            api_time=float(data['api_time']),
+            task_name=data['task_name'],
+            retry_attempts=int(data['retry_attempts']),
+            mode=data.get('mode', 'single'),
+            source_image=data.get('source_image'),
+            source_images=tuple(data.get('source_images') or ()),
+            cdn_url=data.get('cdn_url'),
+            cdn_urls=tuple(data.get('cdn_urls') or ()),
+            prompt_history=tuple(data.get('prompt_history') or ()),
+            stage_index=data.get('stage_index'),
+            replace_prompt=bool(data.get('replace_prompt', False))
+        )
+    
+    @property
+    def total_time(self) -> float:
+        return self.upload_time + self.api_time
+    
+    @property
+    def source_basenames(self) -> List[str]:
+        return [os.path.basename(img) for img in self.source_images]
+    
+    def info_text(self) -> str:
+        """图像详情文本：按模式选择模板一次填充，渲染结果缓存在 rendered_info 中"""
+        if self.rendered_info is None:
+            template = _METADATA_INFO_TEMPLATES.get(self.mode, _METADATA_INFO_TEMPLATES['single'])
+            self.rendered_info = template.format_map({
+                'source_count': len(self.source_images),
+                'source_names': ', '.join(self.source_basenames),
+                'source_image': os.path.basename(self.source_image or 'N/A'),
+                'stage_index': self.stage_index,
+                'replace_prompt': '是' if self.replace_prompt else '否',
+                'history_text': " → ".join(self.prompt_history) if self.prompt_history else self.prompt,
+                'prompt': self.prompt,
+                'model': self.model,
+                'aspect_ratio': self.aspect_ratio,
+                'upload_time': self.upload_time,
+                'api_time': self.api_time,
+                'total_time': self.total_time
+            })
+        return self.rendered_info
+
+
+# 写入快照的元数据字段（与 ImageMetadata 构造参数一一对应）
+_METADATA_SNAPSHOT_FIELDS = (
+    'mode', 'source_image', 'source_images', 'prompt', 'model', 'aspect_ratio',
+    'upload_time', 'api_time', 'task_name', 'cdn_url', 'cdn_urls', 'retry_attempts',
+    'prompt_history', 'stage_index', 'replace_prompt'
+)
+
+
+# 图像详情模板：各模式只有开头几行不同，公共的模型和耗时部分共用
+_METADATA_INFO_COMMON = """🤖 模型: {model}
+📐 宽高比: {aspect_ratio}
+⏱️ 上传耗时: {upload_time:.1f}秒
+⏱️ API耗时: {api_time:.1f}秒
+⏱️ 总耗时: {total_time:.1f}秒"""
+
+_METADATA_INFO_TEMPLATES = {
+    'multi-group': """🔢 模式: 多图分组
+📸 源图像 ({source_count}张):
+   {source_names}
+📝 提示词: {prompt}
+""" + _METADATA_INFO_COMMON,
+    'flexible-stage': """🔢 模式: 灵活分阶段
+📶 阶段: {stage_index}
+🔁 覆盖上一阶段: {replace_prompt}
+📜 提示词链: {history_text}
+📸 源图像 ({source_count}张):
+   {source_names}
+📝 当前提示词: {prompt}
+""" + _METADATA_INFO_COMMON,
+    'single': """🔢 模式: 单图
+📸 源图像: {source_image}
+📝 提示词: {prompt}
+""" + _METADATA_INFO_COMMON,
+}
+
+
+def _append_output_file(output_file, metadata):
+    """记录一张生成成功的输出图像及其元数据（只入队，不与其他任务组争用输出列表锁和元数据锁）"""
+    _pending_outputs.put((output_file, metadata))
+    if _pending_outputs.qsize() >= METADATA_SNAPSHOT_EVERY:
+        _metadata_snapshot_event.set()
+
+
+def _drain_pending_outputs():
+    """把已入队的输出合并进输出列表并保存元数据，读取输出列表或版本号之前调用"""
+    global all_output_version
+    if _pending_outputs.empty():
+        return
+    drained = []
+    evicted_paths = []
+    with all_output_files_lock:
+        while True:
+            try:
+                entry = _pending_outputs.get_nowait()
+            except queue.Empty:
+                break
+            # 画廊已满时最早的输出会被挤出，之后无法再选中，其元数据一并释放
+            if len(all_output_files) == all_output_files.maxlen:
+                evicted_paths.append(all_output_files[0][0])
+            all_output_files.append(entry)
+            drained.append(entry)
+            all_output_version += 1
+        # 本批元数据在一次加锁内写入，生成线程不再逐张争用元数据锁
+        with image_metadata_lock:
+            for evicted_path in evicted_paths:
+                image_metadata.pop(evicted_path, None)
+            for output_file, metadata in drained:
+                _store_image_metadata_locked(output_file, metadata)
+
+
+def _share_prompt_locked(prompt):
+    """返回与已有元数据共享的提示词字符串（调用方需持有 image_metadata_lock）"""
+    shared = _prompt_pool.get(prompt)
+    if shared is None:
+        if len(_prompt_pool) >= MAX_PROMPT_POOL:
+            _prompt_pool.clear()
+        _prompt_pool[prompt] = shared = prompt
+    return shared
+
+
+def _store_image_metadata_locked(output_path, metadata):
+    """保存图像元数据：相同提示词共享同一字符串，超出上限时淘汰最久未使用的条目（调用方需持有 image_metadata_lock）"""
+    metadata.prompt = _share_prompt_locked(metadata.prompt)
+    image_metadata[output_path] = metadata
+    image_metadata.move_to_end(output_path)
+    while len(image_metadata) > MAX_GALLERY_OUTPUTS:
+        image_metadata.popitem(last=False)
+
+
+def _store_image_metadata(output_path, metadata):
+    """保存单张图像的元数据"""
+    with image_metadata_lock:
+        _store_image_metadata_locked(output_path, metadata)
+
+
+def _get_image_metadata(image_path):
+    """读取图像元数据并标记为最近使用，不存在时返回 None"""
+    if not image_path:
+        return None
+    # 只读查询不加锁：单次读取和 move_to_end 在 GIL 下是原子的，写入和淘汰仍在锁内进行
+    metadata = image_metadata.get(image_path)
+    if metadata is not None:
+        try:
+            image_metadata.move_to_end(image_path)
+        except KeyError:
+            pass  # 恰好被淘汰
+    return metadata
+
+
+def _format_gallery_caption(metadata):
+    """画廊标题（简化标题：只显示时间）"""
+    if metadata is None:
+        return ""
+    return f"上传: {metadata.upload_time:.1f}s | API: {metadata.api_time:.1f}s | 总计: {metadata.total_time:.1f}s"
+
+
+def save_metadata_snapshot():
+    """将输出列表及元数据写入快照文件（锁内只复制，序列化和写盘在锁外）"""
+    global _metadata_snapshot_version
+    _drain_pending_outputs()
+    with _metadata_snapshot_lock:
+        with all_output_files_lock:
+            version = all_output_version
+            if version == _metadata_snapshot_version:
+                return
+            # 元数据对象没有可增删的字段，复制列表即可在锁外序列化
+            entries = list(all_output_files)
+        try:
+            records = [[file_path, metadata.to_dict()] for file_path, metadata in entries]
+            tmp_path = METADATA_SNAPSHOT_PATH + ".tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=1) as f:
+                json.dump(records, f, ensure_ascii=False)
+            os.replace(tmp_path, METADATA_SNAPSHOT_PATH)
+            _metadata_snapshot_version = version
+        except Exception as e:
+            print(f"⚠️ 保存元数据快照失败: {e}")
+
+
+def load_metadata_snapshot():
+    """启动时从快照恢复输出列表及元数据，跳过已被删除的图像"""
+    global all_output_version, _metadata_snapshot_version
+    if not os.path.exists(METADATA_SNAPSHOT_PATH):
+        return 0
+    try:
+        with gzip.open(METADATA_SNAPSHOT_PATH, "rt", encoding="utf-8") as f:
+            records = json.load(f)
+        entries = [(file_path, ImageMetadata.from_dict(data)) for file_path, data in records]
+    except Exception as e:
+        print(f"⚠️ 读取元数据快照失败: {e}")
+        return 0
+    
+    existing = set(filter_existing_paths([file_path for file_path, _ in entries]))
+    entries = [(file_path, metadata) for file_path, metadata in entries if file_path in existing]
+    entries = entries[-MAX_GALLERY_OUTPUTS:]
+    
+    for file_path, metadata in entries:
+        _store_image_metadata(file_path, metadata)
+    with all_output_files_lock:
+        all_output_files.extend(entries)
+        # 版本号按条数递增（与 _drain_pending_outputs 一致），画廊缓存才会复制全部恢复的输出
+        all_output_version += len(entries)
+        _metadata_snapshot_version = all_output_version
+    return len(entries)
+
+
+def _metadata_snapshot_loop():
+    """后台快照线程：定时或新增输出较多时写入快照"""
+    while True:
+        _metadata_snapshot_event.wait(METADATA_SNAPSHOT_INTERVAL)
+        _metadata_snapshot_event.clear()
+        save_metadata_snapshot()
+
+
+def start_metadata_snapshotter():
+    """启动后台快照线程，并在进程退出时补写最后一次快照"""
+    threading.Thread(target=_metadata_snapshot_loop, name="metadata-snapshot", daemon=True).start()
+    atexit.register(save_metadata_snapshot)
+
+
 def process_single_task(
     task_id: int,
     image_path: str,
@@ -133,7 +645,7 @@ def process_single_task(
             return task_id, False, "上传失败", time.time() - task_start_time, None
         
         # 调用API
-        client = GrsaiAPI(api_key=api_key)
+        client = get_api_client(api_key)
         pil_images, image_urls, errors = client.banana_generate_image(
             prompt=prompt,
             model=model,
@@ -151,54 +663,402 @@ def process_single_task(
         # 保存图像
         output_filename = f"{task_name}_1.png"
         output_path = os.path.join(output_dir, output_filename)
-        pil_images[0].save(output_path)
+        pil_images[0].save(output_path, format="PNG", compress_level=PNG_COMPRESS_LEVEL, optimize=False)
         
         total_time = time.time() - task_start_time
         return task_id, True, f"成功", total_time, output_path
         
     except Exception as e:
         total_time = time.time() - task_start_time
-        return task_id, False, f"异常: {str(e)}", total_time, None
+        return task_id, False, f"异常: {describe_exception(e)}", total_time, None
+
+
+PATH_EXISTS_TTL = 30  # 源文件存在性检查结果的缓存秒数
+SCANDIR_MIN_PATHS = 4  # 同一目录下待检查的路径达到该数量时，改为列一次目录代替逐个 stat
+_path_exists_cache = {}  # {path: (检查时间, 是否存在)}
+_path_exists_cache_lock = threading.Lock()
+
+
+def path_exists_cached(path: str) -> bool:
+    """带短期缓存的 os.path.exists，避免每次点击重做/重排都访问磁盘"""
+    now = time.time()
+    with _path_exists_cache_lock:
+        cached = _path_exists_cache.get(path)
+        if cached is not None and now - cached[0] < PATH_EXISTS_TTL:
+            return cached[1]
+    exists = os.path.exists(path)
+    with _path_exists_cache_lock:
+        if len(_path_exists_cache) >= MAX_UPLOAD_CACHE:
+            _path_exists_cache.clear()
+        _path_exists_cache[path] = (now, exists)
+    return exists
+
+
+# 源文件存在性检查是纯 I/O，单独用一个小线程池并行 stat
+_path_check_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="path-check")
+
+
+def _check_paths_by_directory(paths) -> dict:
+    """
+    检查一批路径是否存在，返回 {path: 是否存在}
+    
+    同一目录下的路径较多时只 scandir 一次该目录（网络盘上一次列目录远快于多次 stat），结果写入存在性缓存；
+    其余路径并行 stat。文件名按 normcase 比较，与 Windows 上 os.path.exists 不区分大小写一致。
+    """
+    by_dir = defaultdict(list)
+    for path in paths:
+        by_dir[os.path.dirname(path)].append(path)
+    
+    results = {}
+    single_paths = []
+    for directory, dir_paths in by_dir.items():
+        if len(dir_paths) < SCANDIR_MIN_PATHS:
+            single_paths.extend(dir_paths)
+            continue
+        try:
+            with os.scandir(directory or ".") as entries:
+                names = {os.path.normcase(entry.name) for entry in entries}
+        except OSError:
+            single_paths.extend(dir_paths)
+            continue
+        for path in dir_paths:
+            results[path] = os.path.normcase(os.path.basename(path)) in names
+    
+    if results:
+        now = time.time()
+        with _path_exists_cache_lock:
+            if len(_path_exists_cache) + len(results) > MAX_UPLOAD_CACHE:
+                _path_exists_cache.clear()
+            for path, exists in results.items():
+                _path_exists_cache[path] = (now, exists)
+    
+    if len(single_paths) == 1:
+        results[single_paths[0]] = path_exists_cached(single_paths[0])
+    elif single_paths:
+        results.update(zip(single_paths, _path_check_executor.map(path_exists_cached, single_paths)))
+    return results
+
+
+def filter_existing_paths(paths) -> List[str]:
+    """按原顺序返回仍存在的路径；未命中缓存的路径按目录批量或并行检查"""
+    now = time.time()
+    known = {}
+    with _path_exists_cache_lock:
+        for path in paths:
+            cached = _path_exists_cache.get(path)
+            if cached is not None and now - cached[0] < PATH_EXISTS_TTL:
+                known[path] = cached[1]
+    missing = list(dict.fromkeys(p for p in paths if p not in known))
+    if missing:
+        known.update(_check_paths_by_directory(missing))
+    return [p for p in paths if known[p]]
+
+
+# 输入页画廊只显示磁盘上的小缩略图，页面状态里仍保存原图路径（索引一一对应）
+THUMBNAIL_DIR = os.path.join(OUTPUT_DIR, ".thumbs")
+THUMBNAIL_SIZE = (256, 256)
+MAX_THUMBNAIL_CACHE = 4096  # 缩略图缓存最多保留的原图数，超出后淘汰最久未使用的
+_thumbnail_cache = OrderedDict()  # {原图路径: ((文件大小, 修改时间ns), 缩略图路径)}
+_thumbnail_lock = threading.Lock()
+
+
+def get_thumbnail(image_path: str) -> str:
+    """返回图像的缩略图路径（按文件大小和修改时间缓存），生成失败时退回原图路径"""
+    try:
+        st = os.stat(image_path)
+    except OSError:
+        return image_path
+    signature = (st.st_size, st.st_mtime_ns)
+    cached = _thumbnail_cache.get(image_path)
+    if cached is not None and cached[0] == signature:
+        with _thumbnail_lock:
+            if image_path in _thumbnail_cache:
+                _thumbnail_cache.move_to_end(image_path)
+        return cached[1]
+    
+    name = hashlib.blake2b(f"{image_path}|{signature}".encode("utf-8"), digest_size=12).hexdigest()
+    thumb_path = os.path.join(THUMBNAIL_DIR, name + ".jpg")
+    if not os.path.exists(thumb_path):
+        tmp_path = f"{thumb_path}.{threading.get_ident()}.tmp"
+        try:
+            from PIL import Image  # 首次生成缩略图时才加载 PIL
+            
+            _ensure_output_dir(THUMBNAIL_DIR)
+            with Image.open(image_path) as img:
+                img.draft("RGB", THUMBNAIL_SIZE)  # JPEG 直接按缩小的尺寸解码
+                thumb = img.convert("RGB")
+                thumb.thumbnail(THUMBNAIL_SIZE)
+                thumb.save(tmp_path, "JPEG", quality=80)
+            os.replace(tmp_path, thumb_path)
+        except Exception as e:
+            print(f"⚠️ 生成缩略图失败 {os.path.basename(image_path)}: {describe_exception(e)}")
+            try:
+                os.remove(tmp_path)  # 写了一半的临时文件
+            except OSError:
+                pass
+            return image_path
+    
+    with _thumbnail_lock:
+        _thumbnail_cache[image_path] = (signature, thumb_path)
+        _thumbnail_cache.move_to_end(image_path)
+        while len(_thumbnail_cache) > MAX_THUMBNAIL_CACHE:
+            _thumbnail_cache.popitem(last=False)
+    return thumb_path
+
+
+def prune_thumbnail_dir() -> int:
+    """
+    删除缩略图目录中已不在缓存里的文件（被淘汰的、原图已修改的、上次运行留下的及残留的临时文件）
+    
+    Returns:
+        删除的文件数
+    """
+    with _thumbnail_lock:
+        live = {thumb_path for _, thumb_path in _thumbnail_cache.values()}
+    # 最近一分钟内写入的文件可能正由其他线程生成、还没来得及登记到缓存，先保留
+    cutoff = time.time() - 60
+    removed = 0
+    try:
+        entries = list(os.scandir(THUMBNAIL_DIR))
+    except OSError:
+        return 0
+    for entry in entries:
+        if entry.path in live or not entry.is_file():
+            continue
+        try:
+            if entry.stat().st_mtime > cutoff:
+                continue
+            os.remove(entry.path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def gallery_thumbnails(paths) -> Tuple[str, ...]:
+    """按原顺序返回画廊用的缩略图路径（只读元组，与可变的页面状态列表分开）；多张时借用路径检查线程池并行生成"""
+    if len(paths) <= 1:
+        return tuple(get_thumbnail(p) for p in paths)
+    return tuple(_path_check_executor.map(get_thumbnail, paths))
+
+
+def upload_cache_key(image_path: str) -> Tuple[int, bytes]:
+    """
+    计算上传缓存键 (文件大小, 内容摘要)
+    
+    文件被修改后（大小或修改时间变化）会重新计算摘要，不会再命中旧的URL；
+    不同路径下内容相同的文件共用同一个键，只上传一次
+    """
+    st = os.stat(image_path)
+    signature = (st.st_size, st.st_mtime_ns)
+    cached = _file_digest_cache.get(image_path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    
+    digest = hashlib.blake2b(digest_size=16)
+    with open(image_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    key = (st.st_size, digest.digest())
+    with _file_digest_lock:
+        if len(_file_digest_cache) >= MAX_UPLOAD_CACHE:
+            _file_digest_cache.clear()
+        _file_digest_cache[image_path] = (signature, key)
+    return key
+
+
+def lookup_cached_upload(image_path: str) -> Optional[str]:
+    """只用已记录的文件摘要查询URL缓存（不读取文件内容），摘要未记录、文件已变化或未命中时返回 None"""
+    cached = _file_digest_cache.get(image_path)
+    if cached is None:
+        return None
+    try:
+        st = os.stat(image_path)
+    except OSError:
+        return None
+    if cached[0] != (st.st_size, st.st_mtime_ns):
+        return None
+    cdn_url = upload_cache.get(cached[1])
+    if cdn_url is not None:
+        try:
+            upload_cache.move_to_end(cached[1])
+        except KeyError:
+            pass  # 恰好被其他线程淘汰，本次仍可使用读到的URL
+    return cdn_url
+
+
+def submit_upload(executor, task_id: int, image_path: str, api_key: str) -> Future:
+    """提交单张图像上传；已缓存的图像直接返回已完成的 future，不经过线程池排队和线程切换"""
+    cached_url = lookup_cached_upload(image_path)
+    if cached_url is not None:
+        future = Future()
+        future.set_result((task_id, True, "使用缓存", cached_url, 0.0))
+        return future
+    return executor.submit(upload_single_image, task_id, image_path, api_key)
 
 
 def upload_single_image(task_id: int, image_path: str, api_key: str) -> Tuple[int, bool, str, Optional[str], float]:
-    """上传单个图像（带缓存）"""
+    """上传单个图像（按文件内容缓存）"""
     start_time = time.time()
     try:
-        # 检查缓存
-        with upload_cache_lock:
-            if image_path in upload_cache:
-                cached_url = upload_cache[image_path]
-                elapsed = time.time() - start_time
-                return task_id, True, "使用缓存", cached_url, elapsed
+        cache_key = upload_cache_key(image_path)
+        
+        # 缓存命中的快速路径不加锁：OrderedDict 的单次读取和 move_to_end 在 GIL 下是原子的
+        cached_url = upload_cache.get(cache_key)
+        if cached_url is not None:
+            try:
+                upload_cache.move_to_end(cache_key)
+            except KeyError:
+                pass  # 恰好被其他线程淘汰，本次仍可使用读到的URL
+            elapsed = time.time() - start_time
+            return task_id, True, "使用缓存", cached_url, elapsed
+        
+        while True:
+            # 未命中时在锁内复查缓存，并登记由哪个线程负责上传
+            with upload_cache_lock:
+                cached_url = upload_cache.get(cache_key)
+                if cached_url is not None:
+                    upload_cache.move_to_end(cache_key)
+                    elapsed = time.time() - start_time
+                    return task_id, True, "使用缓存", cached_url, elapsed
+                inflight = _upload_inflight.get(cache_key)
+                if inflight is None:
+                    # 由当前线程负责上传
+                    inflight = _upload_inflight[cache_key] = threading.Event()
+                    break
+            # 相同内容的文件正在被其他任务上传，等待其完成后重新检查缓存（对方失败则由本线程重试）
+            inflight.wait()
         
         # 未缓存，执行上传
-        cdn_url = upload_file_zh(image_path, api_key)
+        cdn_url = None
+        try:
+            cdn_url = upload_file_zh(image_path, api_key)
+        finally:
+            with upload_cache_lock:
+                if cdn_url:
+                    # 保存到缓存
+                    upload_cache[cache_key] = cdn_url
+                    upload_cache.move_to_end(cache_key)
+                    while len(upload_cache) > MAX_UPLOAD_CACHE:
+                        upload_cache.popitem(last=False)
+                del _upload_inflight[cache_key]
+            inflight.set()
         elapsed = time.time() - start_time
         
         if cdn_url:
-            # 保存到缓存
-            with upload_cache_lock:
-                upload_cache[image_path] = cdn_url
             return task_id, True, "上传成功", cdn_url, elapsed
         else:
             return task_id, False, "上传失败", None, elapsed
     except Exception as e:
         elapsed = time.time() - start_time
-        return task_id, False, f"上传异常: {str(e)}", None, elapsed
+        return task_id, False, f"上传异常: {describe_exception(e)}", None, elapsed
+
+
+CANCEL_POLL_INTERVAL = 0.5  # 等待任务完成期间检查中止请求的间隔（秒）
+
+
+class CompletionQueue:
+    """
+    收集 future 的完成通知并按批次产出
+    
+    阻塞等待至少一个完成，再一并取出此时已完成的全部；调用方每批只需更新一次进度、检查一次中止。
+    完成通知通过回调放入队列，每个 future 只处理一次；处理过程中可以继续 add 新的 future（如上传完成后提交的 API 任务）。
+    给出 cancel_event 时，长时间没有任务完成也会定期检查中止请求，已中止则产出空批次，让调用方立即退出；
+    未中止时调用 on_idle（如写入尚未提交的进度）。
+    """
+    
+    def __init__(self, cancel_event=None, on_idle=None):
+        self.cancel_event = cancel_event
+        self.on_idle = on_idle
+        self.done_queue = queue.SimpleQueue()
+        self.remaining = 0
+    
+    def add(self, future: Future):
+        self.remaining += 1
+        future.add_done_callback(self.done_queue.put)
+    
+    def batches(self):
+        timeout = CANCEL_POLL_INTERVAL if self.cancel_event is not None else None
+        while self.remaining:
+            try:
+                batch = [self.done_queue.get(timeout=timeout)]
+            except queue.Empty:
+                if self.cancel_event.is_set():
+                    yield []
+                elif self.on_idle is not None:
+                    self.on_idle()
+                continue
+            while True:
+                try:
+                    batch.append(self.done_queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.remaining -= len(batch)
+            yield batch
+
+
+def iter_completed_batches(futures, cancel_event=None, on_idle=None):
+    """按批次产出一组已提交 future 的完成情况（见 CompletionQueue）"""
+    completions = CompletionQueue(cancel_event, on_idle)
+    for future in futures:
+        completions.add(future)
+    return completions.batches()
+
+
+def shutdown_group_executor(executor):
+    """任务组结束时关闭其线程池：中止或异常退出时尚未开始的任务直接取消，只等待正在执行的任务"""
+    if sys.version_info >= (3, 9):
+        executor.shutdown(wait=True, cancel_futures=True)
+    else:
+        executor.shutdown(wait=True)  # Python 3.8 不支持 cancel_futures，排队的任务仍会执行完
+
+
+# 输出图像的PNG编码和写盘在独立的小线程池中进行，不占用API工作线程
+_png_save_pool = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 2), thread_name_prefix="png-save")
+
+
+def save_output_png(image, output_path: str) -> Future:
+    """提交输出图像的保存，返回保存任务的 future"""
+    return _png_save_pool.submit(
+        image.save, output_path, format="PNG", compress_level=PNG_COMPRESS_LEVEL, optimize=False
+    )
+
+
+def wait_output_saved(save_future: Future, message: str) -> Tuple[bool, str]:
+    """等待输出图像写盘完成后才将其计为成功，返回 (是否成功, 消息)"""
+    try:
+        save_future.result()
+    except Exception as e:
+        return False, f"保存失败: {describe_exception(e)}"
+    return True, message
+
+
+RETRY_BACKOFF_CAP = 30  # 重试等待的上限（秒）
+
+
+def retry_backoff(attempt: int) -> float:
+    """第 attempt 次失败后的等待秒数：指数退避 + 完全随机抖动，分散同时失败的并发任务的重试时间"""
+    return random.uniform(0, min(2 ** (attempt - 1), RETRY_BACKOFF_CAP))
+
+
+def describe_exception(e: Exception) -> str:
+    """异常的简短描述（类型名 + 异常信息，OSError 会带上原因和路径），调试模式下同时打印完整堆栈"""
+    if DEBUG:
+        traceback.print_exc()
+    return f"{type(e).__name__}: {e}"
 
 
 def call_banana_api(task_id: int, cdn_url: str, prompt: str, api_key: str, 
                    model: str, aspect_ratio: str, output_dir: str, 
                    task_name: str, upload_time: float, source_image_path: str,
-                   max_retries: int = 3) -> Tuple[int, bool, str, Optional[str], float, dict]:
+                   max_retries: int = 3) -> Tuple[int, bool, str, Optional[str], float, Optional[ImageMetadata], Optional[Future]]:
     """调用 Banana API 生成图像（带重试机制）"""
     start_time = time.time()
     last_error = None
     
     for attempt in range(1, max_retries + 1):
         try:
-            client = GrsaiAPI(api_key=api_key)
+            client = get_api_client(api_key)
             pil_images, image_urls, errors = client.banana_generate_image(
                 prompt=prompt,
                 model=model,
@@ -209,56 +1069,51 @@ def call_banana_api(task_id: int, cdn_url: str, prompt: str, api_key: str,
             if errors:
                 last_error = f"API错误: {', '.join(errors)}"
                 if attempt < max_retries:
-                    time.sleep(1 * attempt)  # 递增等待时间：1s, 2s, 3s
+                    time.sleep(retry_backoff(attempt))  # 指数退避 + 随机抖动，避免并发任务同时重试
                     continue
                 elapsed = time.time() - start_time
-                return task_id, False, f"{last_error} (重试{attempt}次后失败)", None, elapsed, {}
+                return task_id, False, f"{last_error} (重试{attempt}次后失败)", None, elapsed, None, None
             
             if not pil_images:
                 last_error = "未返回图像"
                 if attempt < max_retries:
-                    time.sleep(1 * attempt)
+                    time.sleep(retry_backoff(attempt))
                     continue
                 elapsed = time.time() - start_time
-                return task_id, False, f"{last_error} (重试{attempt}次后失败)", None, elapsed, {}
+                return task_id, False, f"{last_error} (重试{attempt}次后失败)", None, elapsed, None, None
             
             # 保存图像
             output_filename = f"{task_name}_1.png"
             output_path = os.path.join(output_dir, output_filename)
-            pil_images[0].save(output_path)
+            save_future = save_output_png(pil_images[0], output_path)  # 编码写盘交给保存线程，本线程可立即处理下一个请求
             
             elapsed = time.time() - start_time
             
             # 创建元数据（包含源图像路径和重试信息）
-            metadata = {
-                'source_image': source_image_path,
-                'prompt': prompt,
-                'upload_time': upload_time,
-                'api_time': elapsed,
-                'total_time': upload_time + elapsed,
-                'model': model,
-                'aspect_ratio': aspect_ratio,
-                'task_name': task_name,
-                'cdn_url': cdn_url,
-                'retry_attempts': attempt  # 记录重试次数
-            }
-            
-            # 保存到全局字典
-            with image_metadata_lock:
-                image_metadata[output_path] = metadata
+            metadata = ImageMetadata(
+                prompt=prompt,
+                model=model,
+                aspect_ratio=aspect_ratio,
+                upload_time=upload_time,
+                api_time=elapsed,
+                task_name=task_name,
+                retry_attempts=attempt,  # 记录重试次数
+                source_image=source_image_path,
+                cdn_url=cdn_url
+            )
             
             # 成功时显示是否重试过
             success_msg = "生成成功" if attempt == 1 else f"生成成功(重试{attempt}次)"
-            return task_id, True, success_msg, output_path, elapsed, metadata
+            return task_id, True, success_msg, output_path, elapsed, metadata, save_future
             
         except Exception as e:
-            last_error = f"API异常: {str(e)}"
+            last_error = f"API异常: {describe_exception(e)}"
             if attempt < max_retries:
-                time.sleep(1 * attempt)
+                time.sleep(retry_backoff(attempt))
                 continue
             else:
                 elapsed = time.time() - start_time
-                return task_id, False, f"{last_error} (重试{attempt}次后失败)", None, elapsed, {}
+                return task_id, False, f"{last_error} (重试{attempt}次后失败)", None, elapsed, None, None
 
 
 def process_task_group_async(
@@ -279,93 +1134,80 @@ def process_task_group_async(
         output_dir = OUTPUT_DIR
     
     # 初始化任务组状态
-    with task_groups_lock:
-        task_groups[group_id] = {
-            'upload_progress': f"0/{len(images)}",
-            'api_progress': "0/0",
-            'status': "📤 正在上传图像...",
-            'log': []
-        }
+    _init_task_group(group_id, {
+        'upload_progress': f"0/{len(images)}",
+        'api_progress': "0/0",
+        'status': "📤 正在上传图像...",
+        'log': deque(maxlen=MAX_LOG_LINES)
+    })
+    reporter = TaskGroupReporter(group_id)
+    cancel_event = get_task_group_cancel_event(group_id)
+    # 同一任务组的上传、API调用及各阶段共用一个线程池，避免每个阶段重复创建和销毁线程
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"group-{group_id[:8]}")
     
     try:
-        # 获取图像文件列表
-        image_files = []
-        for img in images:
-            if isinstance(img, str):
-                image_files.append(img)
-            elif hasattr(img, 'name'):
-                image_files.append(img.name)
-        
-        log_messages = []
-        log_messages.append(f"🚀 任务组 {group_id[:8]}: {len(image_files)} 图像 × {len(prompts)} 提示词")
-        if is_task_group_cancelled(group_id):
-            log_messages.append("⛔ 任务已在开始前被中止")
-            with task_groups_lock:
-                task_groups[group_id]['status'] = "⛔ 用户已中止"
-                task_groups[group_id]['log'] = log_messages.copy()
+        # 获取图像文件列表，跳过不支持的格式，避免把非图像文件送去上传
+        image_files = [img if isinstance(img, str) else getattr(img, 'name', None) for img in images]
+        image_files = [p for p in image_files if p and os.path.splitext(p)[1].lower() in SUPPORTED_IMAGE_FORMATS]
+        if len(image_files) < len(images):
+            reporter.log(f"⚠️ 已跳过 {len(images) - len(image_files)} 个不支持的文件")
+        
+        reporter.log(f"🚀 任务组 {group_id[:8]}: {len(image_files)} 图像 × {len(prompts)} 提示词")
+        if cancel_event.is_set():
+            reporter.aborted("⛔ 任务已在开始前被中止")
             return
         
         # ========== 阶段1: 上传图像 ==========
         upload_results = {}  # {image_path: (cdn_url, upload_time)}
         upload_completed = 0
         
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            upload_futures = {}
-            
-            for idx, image_path in enumerate(image_files, 1):
-                assigned_key = get_api_key_for_task(idx, all_api_keys)
-                future = executor.submit(upload_single_image, idx, image_path, assigned_key)
-                upload_futures[future] = image_path
-            
-            for future in as_completed(upload_futures):
+        upload_futures = {}
+        
+        for idx, (image_path, assigned_key) in enumerate(zip(image_files, cycle_api_keys(all_api_keys)), 1):
+            future = submit_upload(executor, idx, image_path, assigned_key)
+            upload_futures[future] = image_path
+        
+        for batch in iter_completed_batches(upload_futures, cancel_event, reporter.flush_pending):
+            for future in batch:
                 image_path = upload_futures[future]
                 task_id, success, message, cdn_url, duration = future.result()
                 upload_completed += 1
-                
+            
                 if success:
                     upload_results[image_path] = (cdn_url, duration)  # 保存上传时间
                     # 区分缓存和新上传
                     cache_mark = "💾" if message == "使用缓存" else "✅"
-                    log_messages.append(f"{cache_mark} {message} {os.path.basename(image_path)} ({duration:.1f}s)")
+                    reporter.log(f"{cache_mark} {message} {os.path.basename(image_path)} ({duration:.1f}s)")
                 else:
-                    log_messages.append(f"❌ 上传失败 {os.path.basename(image_path)}")
-                
-                # 更新进度
-                with task_groups_lock:
-                    task_groups[group_id]['upload_progress'] = f"{upload_completed}/{len(image_files)}"
-                    task_groups[group_id]['log'] = log_messages.copy()
-
-                if is_task_group_cancelled(group_id):
-                    log_messages.append("⛔ 上传阶段已中止")
-                    with task_groups_lock:
-                        task_groups[group_id]['status'] = "⛔ 用户已中止"
-                        task_groups[group_id]['log'] = log_messages.copy()
-                    return
-        
+                    reporter.log(f"❌ 上传失败 {os.path.basename(image_path)}")
+            
+            # 更新进度
+            reporter.progress(upload_progress=f"{upload_completed}/{len(image_files)}")
+
+            if cancel_event.is_set():
+                reporter.aborted("⛔ 上传阶段已中止")
+                return
+    
         if not upload_results:
-            with task_groups_lock:
-                task_groups[group_id]['status'] = "❌ 所有图像上传失败"
+            reporter.flush(status="❌ 所有图像上传失败")
             return
         
-        log_messages.append(f"✅ 上传完成: {len(upload_results)}/{len(image_files)}")
-        if is_task_group_cancelled(group_id):
-            log_messages.append("⛔ 上传完成后任务被中止")
-            with task_groups_lock:
-                task_groups[group_id]['status'] = "⛔ 用户已中止"
-                task_groups[group_id]['log'] = log_messages.copy()
+        reporter.log(f"✅ 上传完成: {len(upload_results)}/{len(image_files)}")
+        if cancel_event.is_set():
+            reporter.aborted("⛔ 上传完成后任务被中止")
             return
         
         # ========== 阶段2: 调用API ==========
-        with task_groups_lock:
-            task_groups[group_id]['status'] = "🍌 正在调用Banana API..."
+        reporter.flush(status="🍌 正在调用Banana API...")
         
         api_tasks = []
         task_id = 0
+        task_prefix = f"Task_{group_id[:8]}"  # 任务名前缀每个任务组只拼接一次
         for image_path, (cdn_url, upload_time) in upload_results.items():
+            image_name = os.path.splitext(os.path.basename(image_path))[0]  # 每张图只解析一次文件名
             for prompt_idx, prompt in enumerate(prompts, 1):
                 task_id += 1
-                image_name = os.path.splitext(os.path.basename(image_path))[0]
-                task_name = f"Task_{group_id[:8]}_{task_id}_{image_name}_p{prompt_idx}"
+                task_name = f"{task_prefix}_{task_id}_{image_name}_p{prompt_idx}"
                 api_tasks.append({
                     'task_id': task_id,
                     'cdn_url': cdn_url,
@@ -379,73 +1221,66 @@ def process_task_group_async(
         api_results = []
         api_completed = 0
         
-        with task_groups_lock:
-            task_groups[group_id]['api_progress'] = f"0/{total_api_tasks}"
+        reporter.flush(api_progress=f"0/{total_api_tasks}")
         
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            api_futures = {}
-            
-            for task in api_tasks:
-                assigned_key = get_api_key_for_task(task['task_id'], all_api_keys)
-                future = executor.submit(
-                    call_banana_api,
-                    task['task_id'],
-                    task['cdn_url'],
-                    task['prompt'],
-                    assigned_key,
-                    model,
-                    aspect_ratio,
-                    output_dir,  # 使用传入的输出目录
-                    task['task_name'],
-                    task['upload_time'],  # 传递上传时间
-                    task['source_image'],  # 传递源图像路径
-                    max_retries  # 传递重试次数
-                )
-                api_futures[future] = task
-            
-            for future in as_completed(api_futures):
+        api_futures = {}
+        
+        for task, assigned_key in zip(api_tasks, cycle_api_keys(all_api_keys)):
+            future = executor.submit(
+                call_banana_api,
+                task['task_id'],
+                task['cdn_url'],
+                task['prompt'],
+                assigned_key,
+                model,
+                aspect_ratio,
+                output_dir,  # 使用传入的输出目录
+                task['task_name'],
+                task['upload_time'],  # 传递上传时间
+                task['source_image'],  # 传递源图像路径
+                max_retries  # 传递重试次数
+            )
+            api_futures[future] = task
+        
+        for batch in iter_completed_batches(api_futures, cancel_event, reporter.flush_pending):
+            for future in batch:
                 task = api_futures[future]
-                task_id, success, message, output_file, duration, metadata = future.result()
+                task_id, success, message, output_file, duration, metadata, save_future = future.result()
+                if success:
+                    success, message = wait_output_saved(save_future, message)
                 api_completed += 1
-                
+            
                 api_results.append({
                     'task_id': task_id,
                     'success': success,
                     'output_file': output_file
                 })
-                
+            
                 if success and output_file:
                     # 添加到全局输出列表（包含元数据）
-                    with all_output_files_lock:
-                        all_output_files.append((output_file, metadata))
-                    log_messages.append(f"✅ Task_{task_id}: {message} ({duration:.1f}s)")
+                    _append_output_file(output_file, metadata)
+                    reporter.log(f"✅ Task_{task_id}: {message} ({duration:.1f}s)")
                 else:
-                    log_messages.append(f"❌ Task_{task_id}: {message}")
-                
-                # 更新进度
-                with task_groups_lock:
-                    task_groups[group_id]['api_progress'] = f"{api_completed}/{total_api_tasks}"
-                    task_groups[group_id]['log'] = log_messages.copy()
-
-                if is_task_group_cancelled(group_id):
-                    log_messages.append("⛔ API调用阶段已中止")
-                    with task_groups_lock:
-                        task_groups[group_id]['status'] = "⛔ 用户已中止"
-                        task_groups[group_id]['log'] = log_messages.copy()
-                    return
-        
+                    reporter.log(f"❌ Task_{task_id}: {message}")
+            
+            # 更新进度
+            reporter.progress(api_progress=f"{api_completed}/{total_api_tasks}")
+
+            if cancel_event.is_set():
+                reporter.aborted("⛔ API调用阶段已中止")
+                return
+    
         # 统计结果
         success_count = sum(1 for r in api_results if r['success'])
         
-        with task_groups_lock:
-            task_groups[group_id]['status'] = f"✅ 完成: {success_count}/{total_api_tasks} 成功"
-            task_groups[group_id]['log'] = log_messages
+        reporter.flush(status=f"✅ 完成: {success_count}/{total_api_tasks} 成功")
         
     except Exception as e:
-        with task_groups_lock:
-            task_groups[group_id]['status'] = f"❌ 异常: {str(e)}"
-            task_groups[group_id]['log'].append(f"❌ 异常: {str(e)}")
+        error_msg = f"❌ 异常: {describe_exception(e)}"
+        reporter.log(error_msg)
+        reporter.flush(status=error_msg)
     finally:
+        shutdown_group_executor(executor)
         clear_task_group_cancel_flag(group_id)
 
 
@@ -470,196 +1305,171 @@ def process_multi_group_async(
             all_images.extend(images)
     
     if not all_images:
-        with task_groups_lock:
-            task_groups[group_id] = {
-                'upload_progress': "0/0",
-                'api_progress': "0/0",
-                'status': "❌ 没有图像",
-                'log': ["❌ 所有页面都没有图像"]
-            }
+        _init_task_group(group_id, {
+            'upload_progress': "0/0",
+            'api_progress': "0/0",
+            'status': "❌ 没有图像",
+            'log': deque(["❌ 所有页面都没有图像"], maxlen=MAX_LOG_LINES)
+        })
+        clear_task_group_cancel_flag(group_id)
         return
     
     total_images = len(all_images)
     
     # 初始化任务组状态
-    with task_groups_lock:
-        task_groups[group_id] = {
-            'upload_progress': f"0/{total_images}",
-            'api_progress': "0/0",
-            'status': "📤 正在上传图像...",
-            'log': []
-        }
+    _init_task_group(group_id, {
+        'upload_progress': f"0/{total_images}",
+        'api_progress': "0/0",
+        'status': "📤 正在上传图像...",
+        'log': deque(maxlen=MAX_LOG_LINES)
+    })
+    reporter = TaskGroupReporter(group_id)
+    cancel_event = get_task_group_cancel_event(group_id)
+    # 同一任务组的上传、API调用及各阶段共用一个线程池，避免每个阶段重复创建和销毁线程
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"group-{group_id[:8]}")
     
     try:
-        log_messages = []
-        log_messages.append(f"🚀 任务组 {group_id[:8]}: {total_images} 图像（来自{len(page_images_dict)}页）× {len(prompts)} 提示词")
-        if is_task_group_cancelled(group_id):
-            log_messages.append("⛔ 任务已在开始前被中止")
-            with task_groups_lock:
-                task_groups[group_id]['status'] = "⛔ 用户已中止"
-                task_groups[group_id]['log'] = log_messages.copy()
+        reporter.log(f"🚀 任务组 {group_id[:8]}: {total_images} 图像（来自{len(page_images_dict)}页）× {len(prompts)} 提示词")
+        if cancel_event.is_set():
+            reporter.aborted("⛔ 任务已在开始前被中止")
             return
         
         # ========== 阶段1: 上传所有图像 ==========
         
         upload_results = {}  # {image_path: (cdn_url, upload_time)}
         upload_completed = 0
+        # 多个页面引用同一图像时只提交一次上传（按首次出现顺序去重），API调用仍按原顺序使用全部图像
+        upload_images = list(dict.fromkeys(all_images))
         
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            upload_futures = {}
-            
-            for idx, image_path in enumerate(all_images, 1):
-                assigned_key = get_api_key_for_task(idx, all_api_keys)
-                future = executor.submit(upload_single_image, idx, image_path, assigned_key)
-                upload_futures[future] = image_path
-            
-            for future in as_completed(upload_futures):
+        upload_futures = {}
+        
+        for idx, (image_path, assigned_key) in enumerate(zip(upload_images, cycle_api_keys(all_api_keys)), 1):
+            future = submit_upload(executor, idx, image_path, assigned_key)
+            upload_futures[future] = image_path
+        
+        for batch in iter_completed_batches(upload_futures, cancel_event, reporter.flush_pending):
+            for future in batch:
                 image_path = upload_futures[future]
                 task_id, success, message, cdn_url, duration = future.result()
                 upload_completed += 1
-                
+            
                 if success:
                     upload_results[image_path] = (cdn_url, duration)
                     cache_mark = "💾" if message == "使用缓存" else "✅"
-                    log_messages.append(f"{cache_mark} {message} {os.path.basename(image_path)} ({duration:.1f}s)")
+                    reporter.log(f"{cache_mark} {message} {os.path.basename(image_path)} ({duration:.1f}s)")
                 else:
-                    log_messages.append(f"❌ 上传失败 {os.path.basename(image_path)}")
-                
-                with task_groups_lock:
-                    task_groups[group_id]['upload_progress'] = f"{upload_completed}/{len(all_images)}"
-                    task_groups[group_id]['log'] = log_messages.copy()
-
-                if is_task_group_cancelled(group_id):
-                    log_messages.append("⛔ 上传阶段已中止")
-                    with task_groups_lock:
-                        task_groups[group_id]['status'] = "⛔ 用户已中止"
-                        task_groups[group_id]['log'] = log_messages.copy()
-                    return
-        
+                    reporter.log(f"❌ 上传失败 {os.path.basename(image_path)}")
+            
+            reporter.progress(upload_progress=f"{upload_completed}/{len(upload_images)}")
+
+            if cancel_event.is_set():
+                reporter.aborted("⛔ 上传阶段已中止")
+                return
+    
         if not upload_results:
-            with task_groups_lock:
-                task_groups[group_id]['status'] = "❌ 所有图像上传失败"
+            reporter.flush(status="❌ 所有图像上传失败")
             return
         
-        log_messages.append(f"✅ 上传完成: {len(upload_results)}/{len(all_images)}")
-        if is_task_group_cancelled(group_id):
-            log_messages.append("⛔ 上传完成后任务被中止")
-            with task_groups_lock:
-                task_groups[group_id]['status'] = "⛔ 用户已中止"
-                task_groups[group_id]['log'] = log_messages.copy()
+        reporter.log(f"✅ 上传完成: {len(upload_results)}/{len(upload_images)}")
+        if cancel_event.is_set():
+            reporter.aborted("⛔ 上传完成后任务被中止")
             return
         
         # ========== 阶段2: 调用API（所有图像作为一组） ==========
-        with task_groups_lock:
-            task_groups[group_id]['status'] = "🍌 正在调用Banana API..."
-        
-        # 收集所有上传成功的图像URL
-        all_cdn_urls = []
-        all_source_images = []
-        total_upload_time = 0
-        
-        for img_path in all_images:
-            if img_path in upload_results:
-                cdn_url, upload_time = upload_results[img_path]
-                all_cdn_urls.append(cdn_url)
-                all_source_images.append(img_path)
-                total_upload_time += upload_time
-        
-        if not all_cdn_urls:
-            with task_groups_lock:
-                task_groups[group_id]['status'] = "❌ 所有图像上传失败"
+        reporter.flush(status="🍌 正在调用Banana API...")
+        
+        # 收集所有上传成功的图像URL（保持页面中的图像顺序）
+        uploaded_pairs = [(upload_results[img_path][0], img_path) for img_path in all_images if img_path in upload_results]
+        if not uploaded_pairs:
+            reporter.flush(status="❌ 所有图像上传失败")
             return
+        all_cdn_urls, all_source_images = map(list, zip(*uploaded_pairs))
         
-        avg_upload_time = total_upload_time / len(all_cdn_urls)
+        # 图像是并发上传的，上传阶段耗时取最慢的一张
+        group_upload_time = max(upload_time for _, upload_time in upload_results.values())
         
         # 为每个提示词创建任务（所有图像作为一组）
         api_tasks = []
+        task_suffix = f"multiimg{len(all_cdn_urls)}"
         for prompt_idx, prompt in enumerate(prompts, 1):
             task_id = prompt_idx
-            task_name = f"Task_{group_id[:8]}_{task_id}_multiimg{len(all_cdn_urls)}_p{prompt_idx}"
+            task_name = f"Task_{group_id[:8]}_{task_id}_{task_suffix}_p{prompt_idx}"
             api_tasks.append({
                 'task_id': task_id,
                 'cdn_urls': all_cdn_urls,  # 所有URL作为一个数组
                 'source_images': all_source_images,  # 所有源图像
                 'prompt': prompt,
                 'task_name': task_name,
-                'upload_time': avg_upload_time
+                'upload_time': group_upload_time
             })
         
         total_api_tasks = len(api_tasks)
         api_results = []
         api_completed = 0
         
-        with task_groups_lock:
-            task_groups[group_id]['api_progress'] = f"0/{total_api_tasks}"
+        reporter.flush(api_progress=f"0/{total_api_tasks}")
         
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            api_futures = {}
-            
-            for task in api_tasks:
-                assigned_key = get_api_key_for_task(task['task_id'], all_api_keys)
-                future = executor.submit(
-                    call_banana_api_multi,  # 新的多图API调用函数
-                    task['task_id'],
-                    task['cdn_urls'],
-                    task['prompt'],
-                    assigned_key,
-                    model,
-                    aspect_ratio,
-                    output_dir,
-                    task['task_name'],
-                    task['upload_time'],
-                    task['source_images'],
-                    max_retries
-                )
-                api_futures[future] = task
-            
-            for future in as_completed(api_futures):
+        api_futures = {}
+        
+        for task, assigned_key in zip(api_tasks, cycle_api_keys(all_api_keys)):
+            future = executor.submit(
+                call_banana_api_multi,  # 新的多图API调用函数
+                task['task_id'],
+                task['cdn_urls'],
+                task['prompt'],
+                assigned_key,
+                model,
+                aspect_ratio,
+                output_dir,
+                task['task_name'],
+                task['upload_time'],
+                task['source_images'],
+                max_retries
+            )
+            api_futures[future] = task
+        
+        for batch in iter_completed_batches(api_futures, cancel_event, reporter.flush_pending):
+            for future in batch:
                 task = api_futures[future]
-                task_id, success, message, output_file, duration, metadata = future.result()
+                task_id, success, message, output_file, duration, metadata, save_future = future.result()
+                if success:
+                    success, message = wait_output_saved(save_future, message)
                 api_completed += 1
-                
+            
                 api_results.append({
                     'task_id': task_id,
                     'success': success,
                     'output_file': output_file
                 })
-                
+            
                 if success and output_file:
-                    with all_output_files_lock:
-                        all_output_files.append((output_file, metadata))
-                    log_messages.append(f"✅ Task_{task_id}: {message} ({duration:.1f}s)")
+                    _append_output_file(output_file, metadata)
+                    reporter.log(f"✅ Task_{task_id}: {message} ({duration:.1f}s)")
                 else:
-                    log_messages.append(f"❌ Task_{task_id}: {message}")
-                
-                with task_groups_lock:
-                    task_groups[group_id]['api_progress'] = f"{api_completed}/{total_api_tasks}"
-                    task_groups[group_id]['log'] = log_messages.copy()
-
-                if is_task_group_cancelled(group_id):
-                    log_messages.append("⛔ API调用阶段已中止")
-                    with task_groups_lock:
-                        task_groups[group_id]['status'] = "⛔ 用户已中止"
-                        task_groups[group_id]['log'] = log_messages.copy()
-                    return
-        
+                    reporter.log(f"❌ Task_{task_id}: {message}")
+            
+            reporter.progress(api_progress=f"{api_completed}/{total_api_tasks}")
+
+            if cancel_event.is_set():
+                reporter.aborted("⛔ API调用阶段已中止")
+                return
+    
         success_count = sum(1 for r in api_results if r['success'])
         
-        with task_groups_lock:
-            task_groups[group_id]['status'] = f"✅ 完成: {success_count}/{total_api_tasks} 成功"
-            task_groups[group_id]['log'] = log_messages
+        reporter.flush(status=f"✅ 完成: {success_count}/{total_api_tasks} 成功")
         
     except Exception as e:
-        with task_groups_lock:
-            task_groups[group_id]['status'] = f"❌ 异常: {str(e)}"
-            task_groups[group_id]['log'].append(f"❌ 异常: {str(e)}")
+        error_msg = f"❌ 异常: {describe_exception(e)}"
+        reporter.log(error_msg)
+        reporter.flush(status=error_msg)
     finally:
+        shutdown_group_executor(executor)
         clear_task_group_cancel_flag(group_id)
 
 
 def process_flexible_combinations_async(
     group_id: str,
-    initial_combinations: List[List[str]],
+    valid_pages: List[tuple],
     stage_plan: List[dict],
     all_api_keys: List[str],
     max_workers: int,
@@ -668,378 +1478,383 @@ def process_flexible_combinations_async(
     max_retries: int,
     output_dir: str
 ):
-    """根据阶段计划依次执行图像生成任务"""
+    """根据阶段计划依次执行图像生成任务（初始组合在后台线程中逐个展开）"""
 
     total_stages = len(stage_plan)
     if total_stages == 0:
-        with task_groups_lock:
-            task_groups[group_id] = {
-                'upload_progress': "0/0",
-                'api_progress': "0/0",
-                'status': "❌ 未找到有效阶段",
-                'log': ["❌ 未找到有效的提示词阶段"]
-            }
-        return
-
-    current_states = [
-        {
-            'images': combo,
-            'prompt_text': "",
-            'prompt_history': []
-        }
-        for combo in initial_combinations
-    ]
-
-    log_messages = [
-        f"🚀 任务组 {group_id[:8]}: {len(current_states)} 初始组合 | {total_stages} 个阶段"
-    ]
-
-    with task_groups_lock:
-        task_groups[group_id] = {
+        _init_task_group(group_id, {
             'upload_progress': "0/0",
             'api_progress': "0/0",
-            'status': "等待阶段开始...",
-            'log': log_messages.copy()
-        }
+            'status': "❌ 未找到有效阶段",
+            'log': deque(["❌ 未找到有效的提示词阶段"], maxlen=MAX_LOG_LINES)
+        })
+        clear_task_group_cancel_flag(group_id)
+        return
+
+    _init_task_group(group_id, {
+        'upload_progress': "0/0",
+        'api_progress': "0/0",
+        'status': "等待阶段开始...",
+        'log': deque(maxlen=MAX_LOG_LINES)
+    })
+    reporter = TaskGroupReporter(group_id)
+    cancel_event = get_task_group_cancel_event(group_id)
+    # 上传和 API 调用各用一个线程池，各阶段共用，避免每个阶段重复创建和销毁线程；
+    # 分开后正在上传的图像不会占住 API 调用的线程，上传完成的组合可以立即开始生成
+    upload_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"upload-{group_id[:8]}")
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"group-{group_id[:8]}")
 
     try:
+        # 初始组合由生成器逐个产出：组合数按页面形状直接算出，第一阶段边取边提交，不一次性展开整个笛卡尔积
+        stage_input_count, _ = summarize_page_shapes(tuple((len(images), mode) for images, mode in valid_pages))
+        current_states = (
+            {
+                'images': combo,
+                'prompt_text': "",
+                'prompt_history': ()  # 元组，各阶段间共享而无需复制
+            }
+            for combo in iter_image_combinations_from_valid(valid_pages)
+        )
+        reporter.log(f"🚀 任务组 {group_id[:8]}: {stage_input_count} 初始组合 | {total_stages} 个阶段")
+        # 同时在途（等待上传或API任务未完成）的组合和任务数上限，超出后等有任务完成再继续取组合
+        max_in_flight = max_workers * 2
+
         for stage in stage_plan:
             stage_idx = stage['stage_index']
             suffixes = stage['suffixes']
             stage_description = stage.get('description', f"阶段{stage_idx}")
             replace_prompt = stage.get('replace_prompt', False)
 
-            if is_task_group_cancelled(group_id):
-                log_messages.append(f"⛔ 阶段{stage_idx}: 用户已中止任务")
-                with task_groups_lock:
-                    task_groups[group_id]['status'] = "⛔ 用户已中止"
-                    task_groups[group_id]['log'] = log_messages.copy()
+            if cancel_event.is_set():
+                reporter.aborted(f"⛔ 阶段{stage_idx}: 用户已中止任务")
                 return
 
-            if not current_states:
-                log_messages.append(f"❌ 阶段{stage_idx}: 无可用输入，生成提前结束")
-                with task_groups_lock:
-                    task_groups[group_id]['status'] = f"❌ 阶段{stage_idx}: 无可用输入"
-                    task_groups[group_id]['log'] = log_messages.copy()
+            if not stage_input_count:
+                reporter.log(f"❌ 阶段{stage_idx}: 无可用输入，生成提前结束")
+                reporter.flush(status=f"❌ 阶段{stage_idx}: 无可用输入")
                 return
 
-            stage_input_count = len(current_states)
             stage_prompt_count = len(suffixes)
             stage_task_estimate = stage_input_count * stage_prompt_count
-            log_messages.append(
+            reporter.log(
                 f"🚀 阶段{stage_idx}: {stage_description} | 输入 {stage_input_count} × 提示 {stage_prompt_count} ≈ {stage_task_estimate}"
             )
 
-            # 计算阶段提示
-            stage_prompts_per_combo = []
-            stage_histories_per_combo = []
-            for state in current_states:
-                base_prompt = state['prompt_text']
-                base_history = state['prompt_history']
-                prompts_for_combo = []
-                histories_for_combo = []
-                for suffix in suffixes:
-                    if replace_prompt:
-                        final_prompt = suffix
-                        if not final_prompt or not final_prompt.strip():
-                            continue
-                        prompts_for_combo.append(final_prompt)
-                        histories_for_combo.append(base_history + [suffix] if suffix else base_history[:])
-                        continue
-                    final_prompt = base_prompt
-                    if base_prompt and suffix:
-                        final_prompt = f"{base_prompt}, {suffix}"
-                    elif not base_prompt:
-                        final_prompt = suffix
-                    # 如果最终提示为空，则跳过
-                    if not final_prompt.strip():
-                        continue
-                    prompts_for_combo.append(final_prompt)
-                    if suffix:
-                        histories_for_combo.append(base_history + [suffix])
-                    else:
-                        histories_for_combo.append(base_history[:])
-                stage_prompts_per_combo.append(prompts_for_combo)
-                stage_histories_per_combo.append(histories_for_combo)
-
-            # 收集需要上传的图像
-            unique_images = []
-            for state in current_states:
-                for img in state['images']:
-                    if img not in unique_images:
-                        unique_images.append(img)
-
-            with task_groups_lock:
-                task_groups[group_id]['status'] = f"📤 阶段{stage_idx}/{total_stages}: 正在上传图像..."
-                task_groups[group_id]['upload_progress'] = f"阶段{stage_idx}: 0/{len(unique_images)}"
-                task_groups[group_id]['log'] = log_messages.copy()
-
-            upload_results = {}
-            if unique_images:
-                if is_task_group_cancelled(group_id):
-                    log_messages.append(f"⛔ 阶段{stage_idx}: 用户已中止任务（跳过上传）")
-                    with task_groups_lock:
-                        task_groups[group_id]['status'] = "⛔ 用户已中止"
-                        task_groups[group_id]['log'] = log_messages.copy()
-                    return
-                with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                    upload_futures = {}
-                    for idx, image_path in enumerate(unique_images, 1):
-                        assigned_key = get_api_key_for_task(idx, all_api_keys)
-                        future = executor.submit(upload_single_image, idx, image_path, assigned_key)
-                        upload_futures[future] = image_path
-
-                    uploaded = 0
-                    for future in as_completed(upload_futures):
-                        image_path = upload_futures[future]
-                        task_id, success, message, cdn_url, duration = future.result()
-                        uploaded += 1
-                        if success and cdn_url:
-                            upload_results[image_path] = (cdn_url, duration)
-                        mark = "✅" if success else "❌"
-                        log_messages.append(f"{mark} 阶段{stage_idx} 上传 {os.path.basename(image_path)} ({duration:.1f}s) - {message}")
-                        with task_groups_lock:
-                            task_groups[group_id]['upload_progress'] = f"阶段{stage_idx}: {uploaded}/{len(unique_images)}"
-                            task_groups[group_id]['log'] = log_messages.copy()
-
-                        if is_task_group_cancelled(group_id):
-                            log_messages.append(f"⛔ 阶段{stage_idx}: 上传阶段已中止")
-                            with task_groups_lock:
-                                task_groups[group_id]['status'] = "⛔ 用户已中止"
-                                task_groups[group_id]['log'] = log_messages.copy()
-                            return
-
-            if unique_images and not upload_results:
-                with task_groups_lock:
-                    task_groups[group_id]['status'] = f"❌ 阶段{stage_idx}: 上传失败"
-                    task_groups[group_id]['log'] = log_messages.copy()
-                return
+            # 计算阶段提示：空白后缀只需在每个阶段判断一次
+            # 覆盖模式或还没有前序提示词时，最终提示词就是后缀本身，空白后缀跳过；
+            # 否则在前序提示词（上一阶段已保证非空）后追加后缀，空后缀时沿用前序提示词
+            nonblank_suffixes = [suffix for suffix in suffixes if suffix.strip()]
+            if isinstance(current_states, list):
+                planned_tasks = sum(
+                    len(nonblank_suffixes) if replace_prompt or not state['prompt_text'] else stage_prompt_count
+                    for state in current_states
+                )
+            else:
+                planned_tasks = stage_input_count * len(nonblank_suffixes)  # 初始组合都还没有提示词
 
-            log_messages.append(f"✅ 阶段{stage_idx}: 上传完成 {len(upload_results)}/{len(unique_images)}")
+            if planned_tasks == 0:
+                reporter.log(f"⚠️ 阶段{stage_idx}: 未生成任何任务，提前结束")
+                reporter.flush(status=f"⚠️ 阶段{stage_idx}: 无任务")
+                return
 
-            # 构建 API 任务
-            api_tasks = []
-            sequence = 0
-            for combo_idx, (state, prompts_for_combo, histories_for_combo) in enumerate(zip(current_states, stage_prompts_per_combo, stage_histories_per_combo), 1):
-                if not prompts_for_combo:
-                    continue
-                combo_images = state['images']
-                combo_urls = []
-                combo_upload_times = []
-                missing_upload = False
-                for img_path in combo_images:
-                    if img_path in upload_results:
-                        cdn_url, upload_time = upload_results[img_path]
-                        combo_urls.append(cdn_url)
-                        combo_upload_times.append(upload_time)
-                    else:
-                        missing_upload = True
-                        break
-                if missing_upload or not combo_urls:
-                    continue
-                avg_upload_time = sum(combo_upload_times) / len(combo_upload_times)
-                for prompt_idx, prompt in enumerate(prompts_for_combo, 1):
-                    history = histories_for_combo[prompt_idx - 1] if prompt_idx - 1 < len(histories_for_combo) else histories_for_combo[-1]
-                    sequence += 1
-                    task_name = f"Task_{group_id[:8]}_S{stage_idx}_C{combo_idx}_P{prompt_idx}"
-                    api_tasks.append({
+            stage_prefix = f"Task_{group_id[:8]}_S{stage_idx}"  # 任务名前缀每个阶段只拼接一次
+            stage_keys = cycle_api_keys(all_api_keys)
+            state_iter = enumerate(current_states)
+            upload_results = {}  # {图像路径: (cdn_url, 上传耗时)}
+            failed_uploads = set()
+            combos_by_image = {}  # {上传中的图像路径: [等待它的组合, ...]}
+            upload_futures = {}
+            api_futures = {}  # 只保存未完成的 API 任务，处理后移除
+            stage_success_outputs = [None] * planned_tasks  # 按任务序号存放成功的输出，保持组合顺序而无需排序
+            total_api_tasks = planned_tasks  # 组合因上传失败被跳过时相应减少
+            next_sequence = 0  # 已取出的组合规划的任务数，即下一个组合第一个任务之前的序号
+            waiting_combos = 0
+            source_exhausted = False
+            uploads_requested = 0
+            api_submitted = 0
+            success_count = 0
+            api_completed = 0
+            uploaded = 0
+            completions = CompletionQueue(cancel_event, reporter.flush_pending)
+
+            def submit_combo_tasks(combo):
+                """组合的图像全部上传成功后，提交该组合的全部 API 任务（共用同一组URL元组）"""
+                nonlocal api_submitted
+                combo_images = combo['images']
+                uploaded_entries = [upload_results[img_path] for img_path in combo_images]
+                combo_urls = tuple(cdn_url for cdn_url, _ in uploaded_entries)
+                avg_upload_time = sum(upload_time for _, upload_time in uploaded_entries) / len(uploaded_entries)
+                for prompt_idx, (prompt, history) in enumerate(zip(combo['prompts'], combo['histories']), 1):
+                    sequence = combo['sequence_base'] + prompt_idx
+                    task = {
                         'sequence': sequence,
-                        'task_id': sequence,
-                        'cdn_urls': combo_urls,
-                        'source_images': combo_images,
                         'prompt': prompt,
-                        'task_name': task_name,
-                        'upload_time': avg_upload_time,
                         'history': history
-                    })
-
-            total_api_tasks = len(api_tasks)
-            if total_api_tasks == 0:
-                log_messages.append(f"⚠️ 阶段{stage_idx}: 未生成任何任务，提前结束")
-                with task_groups_lock:
-                    task_groups[group_id]['status'] = f"⚠️ 阶段{stage_idx}: 无任务"
-                    task_groups[group_id]['log'] = log_messages.copy()
-                return
-
-            if is_task_group_cancelled(group_id):
-                log_messages.append(f"⛔ 阶段{stage_idx}: 用户已中止任务（跳过API调用）")
-                with task_groups_lock:
-                    task_groups[group_id]['status'] = "⛔ 用户已中止"
-                    task_groups[group_id]['log'] = log_messages.copy()
-                return
-
-            with task_groups_lock:
-                task_groups[group_id]['status'] = f"🍌 阶段{stage_idx}/{total_stages}: 正在调用Banana API..."
-                task_groups[group_id]['api_progress'] = f"阶段{stage_idx}: 0/{total_api_tasks}"
-                task_groups[group_id]['log'] = log_messages.copy()
-
-            stage_success_outputs = {}
-            api_completed = 0
-
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                api_futures = {}
-                for task in api_tasks:
-                    assigned_key = get_api_key_for_task(task['task_id'], all_api_keys)
+                    }
                     future = executor.submit(
                         call_banana_api_multi,
-                        task['task_id'],
-                        task['cdn_urls'],
-                        task['prompt'],
-                        assigned_key,
+                        sequence,
+                        combo_urls,
+                        prompt,
+                        next(stage_keys),
                         model,
                         aspect_ratio,
                         output_dir,
-                        task['task_name'],
-                        task['upload_time'],
-                        task['source_images'],
+                        f"{stage_prefix}_C{combo['index'] + 1}_P{prompt_idx}",
+                        avg_upload_time,
+                        combo_images,
                         max_retries,
                         {
-                            'prompt_history': task['history'],
+                            'prompt_history': history,
                             'stage_index': stage_idx,
                             'replace_prompt': replace_prompt
                         }
                     )
                     api_futures[future] = task
+                    completions.add(future)
+                api_submitted += len(combo['prompts'])
+
+            def pull_combos():
+                """
+                继续从输入中取组合，直到在途的组合和 API 任务达到上限或输入取完
+                
+                每个组合的图像按首次出现顺序去重，尚未上传的立即提交上传（同一图像只上传一次），
+                已上传的直接复用；所需图像全部就绪的组合立即提交 API 任务
+                """
+                nonlocal next_sequence, waiting_combos, source_exhausted, total_api_tasks, uploads_requested
+                while waiting_combos + len(api_futures) < max_in_flight:
+                    item = next(state_iter, None)
+                    if item is None:
+                        source_exhausted = True
+                        return
+                    combo_idx, state = item
+                    combo_images = tuple(state['images'])
+                    base_prompt = state['prompt_text']
+                    base_history = state['prompt_history']
+                    if replace_prompt or not base_prompt:
+                        combo_suffixes = nonblank_suffixes
+                        prompts_for_combo = nonblank_suffixes  # 只读，各组合共用
+                    else:
+                        combo_suffixes = suffixes
+                        prompts_for_combo = [f"{base_prompt}, {suffix}" if suffix else base_prompt for suffix in suffixes]
+                    # 没有提示词的组合不会产生任务，它的图像也不必上传
+                    if not combo_images or not prompts_for_combo:
+                        continue
+                    combo = {
+                        'index': combo_idx,
+                        'images': combo_images,
+                        'prompts': prompts_for_combo,
+                        'histories': [base_history + (suffix,) if suffix else base_history for suffix in combo_suffixes],
+                        'sequence_base': next_sequence,
+                        'waiting': 0  # 还差几张图像上传完成，上传失败的组合记为 -1
+                    }
+                    next_sequence += len(prompts_for_combo)
+
+                    pending_images = []
+                    for img_path in dict.fromkeys(combo_images):
+                        if img_path in upload_results:
+                            continue
+                        if img_path in failed_uploads:
+                            combo['waiting'] = -1
+                            break
+                        pending_images.append(img_path)
+                    if combo['waiting'] < 0:
+                        total_api_tasks -= len(prompts_for_combo)
+                        continue
+                    if not pending_images:
+                        submit_combo_tasks(combo)
+                        continue
+
+                    combo['waiting'] = len(pending_images)
+                    waiting_combos += 1
+                    for img_path in pending_images:
+                        waiters = combos_by_image.get(img_path)
+                        if waiters is None:
+                            waiters = combos_by_image[img_path] = []
+                            uploads_requested += 1
+                            future = submit_upload(upload_executor, uploads_requested, img_path, next(stage_keys))
+                            upload_futures[future] = img_path
+                            completions.add(future)
+                        waiters.append(combo)
+
+            pull_combos()
+            uploads_logged = False
+            reporter.flush(
+                status=f"📤 阶段{stage_idx}/{total_stages}: 正在上传图像，上传完成的组合立即调用Banana API...",
+                upload_progress=f"阶段{stage_idx}: 0/{uploads_requested}",
+                api_progress=f"阶段{stage_idx}: 0/{total_api_tasks}"
+            )
 
-                for future in as_completed(api_futures):
-                    task = api_futures[future]
-                    result_task_id, success, message, output_file, duration, metadata = future.result()
+            for batch in completions.batches():
+                for future in batch:
+                    image_path = upload_futures.pop(future, None)
+                    if image_path is not None:
+                        task_id, success, message, cdn_url, duration = future.result()
+                        uploaded += 1
+                        mark = "✅" if success else "❌"
+                        reporter.log(f"{mark} 阶段{stage_idx} 上传 {os.path.basename(image_path)} ({duration:.1f}s) - {message}")
+                        upload_ok = bool(success and cdn_url)
+                        if upload_ok:
+                            upload_results[image_path] = (cdn_url, duration)
+                        else:
+                            failed_uploads.add(image_path)
+                        for combo in combos_by_image.pop(image_path):
+                            if combo['waiting'] <= 0:
+                                continue
+                            if not upload_ok:
+                                combo['waiting'] = -1
+                                waiting_combos -= 1
+                                total_api_tasks -= len(combo['prompts'])
+                                continue
+                            combo['waiting'] -= 1
+                            if combo['waiting'] == 0:
+                                waiting_combos -= 1
+                                submit_combo_tasks(combo)
+                        continue
+
+                    task = api_futures.pop(future)
+                    result_task_id, success, message, output_file, duration, metadata, save_future = future.result()
+                    if success:
+                        success, message = wait_output_saved(save_future, message)
                     api_completed += 1
 
                     if success and output_file:
-                        stage_success_outputs[task['sequence']] = {
-                            'images': [output_file],
+                        success_count += 1
+                        stage_success_outputs[task['sequence'] - 1] = {
+                            'images': (output_file,),  # 元组：下一阶段构建任务时 tuple() 直接复用，不再复制
                             'prompt_text': task['prompt'],
                             'prompt_history': task['history']
                         }
-                        with all_output_files_lock:
-                            all_output_files.append((output_file, metadata))
-                        log_messages.append(f"✅ 阶段{stage_idx} 任务{result_task_id}: {message} ({duration:.1f}s)")
+                        _append_output_file(output_file, metadata)
+                        reporter.log(f"✅ 阶段{stage_idx} 任务{result_task_id}: {message} ({duration:.1f}s)")
                     else:
-                        log_messages.append(f"❌ 阶段{stage_idx} 任务{result_task_id}: {message}")
+                        reporter.log(f"❌ 阶段{stage_idx} 任务{result_task_id}: {message}")
+
+                # 有任务完成腾出位置后再取后续组合
+                if not source_exhausted:
+                    pull_combos()
+                if source_exhausted and not combos_by_image and not uploads_logged:
+                    uploads_logged = True
+                    reporter.log(f"✅ 阶段{stage_idx}: 上传完成 {len(upload_results)}/{uploads_requested}")
+                    if api_futures:
+                        reporter.progress(status=f"🍌 阶段{stage_idx}/{total_stages}: 正在调用Banana API...")
+
+                reporter.progress(
+                    upload_progress=f"阶段{stage_idx}: {uploaded}/{uploads_requested}",
+                    api_progress=f"阶段{stage_idx}: {api_completed}/{total_api_tasks}"
+                )
 
-                    with task_groups_lock:
-                        task_groups[group_id]['api_progress'] = f"阶段{stage_idx}: {api_completed}/{total_api_tasks}"
-                        task_groups[group_id]['log'] = log_messages.copy()
+                if cancel_event.is_set():
+                    stage_part = "上传" if combos_by_image or not source_exhausted else "API调用"
+                    reporter.aborted(f"⛔ 阶段{stage_idx}: {stage_part}阶段已中止")
+                    return
 
-                    if is_task_group_cancelled(group_id):
-                        log_messages.append(f"⛔ 阶段{stage_idx}: API调用阶段已中止")
-                        with task_groups_lock:
-                            task_groups[group_id]['status'] = "⛔ 用户已中止"
-                            task_groups[group_id]['log'] = log_messages.copy()
-                        return
+            if not api_submitted:
+                if not upload_results:
+                    reporter.flush(status=f"❌ 阶段{stage_idx}: 上传失败")
+                else:
+                    reporter.log(f"⚠️ 阶段{stage_idx}: 未生成任何任务，提前结束")
+                    reporter.flush(status=f"⚠️ 阶段{stage_idx}: 无任务")
+                return
 
-            success_count = len(stage_success_outputs)
-            log_messages.append(f"✅ 阶段{stage_idx}: 成功 {success_count}/{total_api_tasks}")
+            reporter.log(f"✅ 阶段{stage_idx}: 成功 {success_count}/{total_api_tasks}")
 
             if success_count == 0:
-                with task_groups_lock:
-                    task_groups[group_id]['status'] = f"❌ 阶段{stage_idx}: 全部任务失败"
-                    task_groups[group_id]['log'] = log_messages.copy()
+                reporter.flush(status=f"❌ 阶段{stage_idx}: 全部任务失败")
                 return
 
             # 更新为下一阶段的输入
-            new_states = [stage_success_outputs[idx] for idx in sorted(stage_success_outputs.keys())]
-            current_states = new_states
+            current_states = [state for state in stage_success_outputs if state is not None]
+            stage_input_count = len(current_states)
 
-            with task_groups_lock:
-                task_groups[group_id]['status'] = f"✅ 阶段{stage_idx}/{total_stages}: 完成"
-                task_groups[group_id]['log'] = log_messages.copy()
+            reporter.flush(status=f"✅ 阶段{stage_idx}/{total_stages}: 完成")
 
-        with task_groups_lock:
-            task_groups[group_id]['status'] = "✅ 全部阶段完成"
-            task_groups[group_id]['upload_progress'] = "完成"
-            task_groups[group_id]['api_progress'] = "完成"
-            task_groups[group_id]['log'] = log_messages.copy()
+        reporter.flush(
+            status="✅ 全部阶段完成",
+            upload_progress="完成",
+            api_progress="完成"
+        )
 
     except Exception as e:
-        error_msg = f"❌ 异常: {str(e)}"
-        log_messages.append(error_msg)
-        with task_groups_lock:
-            task_groups[group_id]['status'] = error_msg
-            existing_log = task_groups[group_id].get('log', [])
-            existing_log.append(error_msg)
-            task_groups[group_id]['log'] = existing_log
+        error_msg = f"❌ 异常: {describe_exception(e)}"
+        reporter.log(error_msg)
+        reporter.flush(status=error_msg)
     finally:
+        shutdown_group_executor(upload_executor)
+        shutdown_group_executor(executor)
         clear_task_group_cancel_flag(group_id)
 
 
 def call_banana_api_multi(task_id: int, cdn_urls: List[str], prompt: str, api_key: str, 
                          model: str, aspect_ratio: str, output_dir: str, 
                          task_name: str, upload_time: float, source_images: List[str],
-                         max_retries: int = 3, extra_metadata: Optional[dict] = None) -> Tuple[int, bool, str, Optional[str], float, dict]:
+                         max_retries: int = 3, extra_metadata: Optional[dict] = None) -> Tuple[int, bool, str, Optional[str], float, Optional[ImageMetadata], Optional[Future]]:
     """调用 Banana API 生成图像（多图输入版本）"""
     start_time = time.time()
     last_error = None
     
     for attempt in range(1, max_retries + 1):
         try:
-            client = GrsaiAPI(api_key=api_key)
+            client = get_api_client(api_key)
             pil_images, image_urls, errors = client.banana_generate_image(
                 prompt=prompt,
                 model=model,
-                urls=cdn_urls,  # 传递多个URL
+                urls=list(cdn_urls),  # 传递多个URL
                 aspect_ratio=aspect_ratio
             )
             
             if errors:
                 last_error = f"API错误: {', '.join(errors)}"
                 if attempt < max_retries:
-                    time.sleep(1 * attempt)
+                    time.sleep(retry_backoff(attempt))
                     continue
                 elapsed = time.time() - start_time
-                return task_id, False, f"{last_error} (重试{attempt}次后失败)", None, elapsed, {}
+                return task_id, False, f"{last_error} (重试{attempt}次后失败)", None, elapsed, None, None
             
             if not pil_images:
                 last_error = "未返回图像"
                 if attempt < max_retries:
-                    time.sleep(1 * attempt)
+                    time.sleep(retry_backoff(attempt))
                     continue
                 elapsed = time.time() - start_time
-                return task_id, False, f"{last_error} (重试{attempt}次后失败)", None, elapsed, {}
+                return task_id, False, f"{last_error} (重试{attempt}次后失败)", None, elapsed, None, None
             
             # 保存图像
             output_filename = f"{task_name}_1.png"
             output_path = os.path.join(output_dir, output_filename)
-            pil_images[0].save(output_path)
+            save_future = save_output_png(pil_images[0], output_path)  # 编码写盘交给保存线程，本线程可立即处理下一个请求
             
             elapsed = time.time() - start_time
             
             # 创建元数据（多源图像）
-            metadata = {
-                'source_images': source_images,  # 列表
-                'source_image_count': len(source_images),
-                'prompt': prompt,
-                'upload_time': upload_time,
-                'api_time': elapsed,
-                'total_time': upload_time + elapsed,
-                'model': model,
-                'aspect_ratio': aspect_ratio,
-                'task_name': task_name,
-                'cdn_urls': cdn_urls,
-                'retry_attempts': attempt,
-                'mode': 'multi-group'
-            }
-
-            if extra_metadata:
-                metadata.update(extra_metadata)
-                if 'stage_index' in extra_metadata and metadata.get('mode') == 'multi-group':
-                    metadata['mode'] = 'flexible-stage'
-            
-            with image_metadata_lock:
-                image_metadata[output_path] = metadata
+            extra_metadata = extra_metadata or {}
+            metadata = ImageMetadata(
+                prompt=prompt,
+                model=model,
+                aspect_ratio=aspect_ratio,
+                upload_time=upload_time,
+                api_time=elapsed,
+                task_name=task_name,
+                retry_attempts=attempt,
+                mode='flexible-stage' if 'stage_index' in extra_metadata else 'multi-group',
+                source_images=tuple(source_images),  # 元组，比列表更紧凑
+                cdn_urls=tuple(cdn_urls),
+                prompt_history=tuple(extra_metadata.get('prompt_history', ())),
+                stage_index=extra_metadata.get('stage_index'),
+                replace_prompt=extra_metadata.get('replace_prompt', False)
+            )
             
             success_msg = "生成成功" if attempt == 1 else f"生成成功(重试{attempt}次)"
-            return task_id, True, success_msg, output_path, elapsed, metadata
+            return task_id, True, success_msg, output_path, elapsed, metadata, save_future
             
         except Exception as e:
-            last_error = f"API异常: {str(e)}"
+            last_error = f"API异常: {describe_exception(e)}"
             if attempt < max_retries:
-                time.sleep(1 * attempt)
+                time.sleep(retry_backoff(attempt))
                 continue
             else:
                 elapsed = time.time() - start_time
-                return task_id, False, f"{last_error} (重试{attempt}次后失败)", None, elapsed, {}
+                return task_id, False, f"{last_error} (重试{attempt}次后失败)", None, elapsed, None, None
 
 
 def batch_generate(
@@ -1056,60 +1871,54 @@ def batch_generate(
 ):
     """立即提交任务组并返回"""
     
+    # 各文本输入只 strip 一次，后续统一使用
+    prompts_text = prompts_text.strip()
+    main_api_key = main_api_key.strip()
+    backup_api_keys = backup_api_keys.strip() if backup_api_keys else ""
+    output_dir = (output_dir or "").strip() or OUTPUT_DIR
+    
     # 验证输入
     if not images:
         return "❌ 请上传至少一张图像", None, ""
     
-    if not prompts_text.strip():
+    if not prompts_text:
         return "❌ 请输入提示词", None, ""
     
-    if not main_api_key.strip():
+    if not main_api_key:
         return "❌ 请输入主API密钥", None, ""
     
-    # 验证并创建输出目录
-    if not output_dir or not output_dir.strip():
-        output_dir = OUTPUT_DIR
-    else:
-        output_dir = output_dir.strip()
-    
+    # 创建输出目录
     try:
-        os.makedirs(output_dir, exist_ok=True)
+        _ensure_output_dir(output_dir)
     except Exception as e:
         return f"❌ 无法创建输出目录: {str(e)}", None, ""
     
     # 解析提示词
-    prompts = [line.strip() for line in prompts_text.strip().split('\n') if line.strip()]
+    prompts = split_nonempty_lines(prompts_text)
     if not prompts:
         return "❌ 请输入有效的提示词", None, ""
     
     # 准备API密钥列表
-    all_api_keys = [main_api_key.strip()]
-    if use_multiple_accounts and backup_api_keys.strip():
-        backup_keys = [k.strip() for k in backup_api_keys.strip().split('\n') if k.strip()]
-        all_api_keys.extend(backup_keys)
+    all_api_keys = build_api_key_list(main_api_key, backup_api_keys, use_multiple_accounts)
     
     # 生成任务组ID
-    group_id = str(uuid.uuid4())
+    group_id = new_task_group_id()
     
     register_task_group_for_cancel(group_id)
 
     # 在后台线程中启动任务处理
-    thread = threading.Thread(
-        target=process_task_group_async,
-        args=(
-            group_id,
-            images,
-            prompts,
-            all_api_keys,
-            max_workers,
-            model,
-            aspect_ratio,
-            max_retries,
-            output_dir  # 传递输出目录
-        ),
-        daemon=True
+    submit_task_group(
+        process_task_group_async,
+        group_id,
+        images,
+        prompts,
+        all_api_keys,
+        max_workers,
+        model,
+        aspect_ratio,
+        max_retries,
+        output_dir  # 传递输出目录
     )
-    thread.start()
     
     # 立即返回
     image_count = len(images) if isinstance(images, list) else 1
@@ -1122,45 +1931,84 @@ def batch_generate(
     )
 
 
-def calculate_image_combinations(pages_data):
+def split_nonempty_lines(text):
+    """按行切分文本，去除每行首尾空白并丢弃空行（兼容 Windows 换行）"""
+    return [line for line in map(str.strip, text.splitlines()) if line]
+
+
+@lru_cache(maxsize=8)
+def build_api_key_list(main_api_key, backup_api_keys, use_multiple_accounts):
+    """
+    组装API密钥列表（主密钥在前），按顺序去重，避免同一密钥占用多个轮换位置
+    
+    密钥输入很少变化，按原始输入缓存解析结果；返回不可变元组，可在任务间共享
+    """
+    keys = [main_api_key]
+    if use_multiple_accounts and backup_api_keys:
+        keys.extend(split_nonempty_lines(backup_api_keys))
+    return tuple(dict.fromkeys(keys))
+
+
+def iter_image_combinations_from_valid(valid_pages):
     """
-    计算所有可能的图像组合
+    逐个生成图像组合（调用方已过滤掉空页面），不一次性展开整个笛卡尔积
     
     Args:
-        pages_data: [(images_list, mode), ...] 每页的图像列表和组合模式
+        valid_pages: [(images_list, mode), ...] 仅包含有图像的页面
+    
+    Yields:
+        [image1, image2, ...] 按页面顺序拼接的一个组合
+    """
+    from itertools import product, chain
+    
+    if not valid_pages:
+        return
+    
+    multiply_positions = [i for i, (_, mode) in enumerate(valid_pages) if mode == "相乘"]
+    
+    # 没有相乘页面：所有图像合并为唯一的组合
+    if not multiply_positions:
+        yield list(chain.from_iterable(images for images, _ in valid_pages))
+        return
+    
+    # 只有一个相乘页面：该页每张图与前后相加页面的图像拼接
+    if len(multiply_positions) == 1:
+        pos = multiply_positions[0]
+        prefix = list(chain.from_iterable(images for images, _ in valid_pages[:pos]))
+        suffix = list(chain.from_iterable(images for images, _ in valid_pages[pos + 1:]))
+        for img in valid_pages[pos][0]:
+            yield prefix + [img] + suffix
+        return
+    
+    # 为每个页面准备可能的选项（不可变元组，各组合共享引用）
+    # 相乘：每张图作为一个单独的选项；相加：所有图像作为一个整体
+    page_options = [
+        tuple((img,) for img in images) if mode == "相乘" else (tuple(images),)
+        for images, mode in valid_pages
+    ]
+    
+    # 计算笛卡尔积，按页面顺序一次性拼接每个组合
+    for combo in product(*page_options):
+        yield list(chain.from_iterable(combo))
+
+
+@lru_cache(maxsize=64)
+def summarize_page_shapes(page_shapes) -> Tuple[int, int]:
+    """
+    按 (图像数, 模式) 形状一次遍历得到组合数和相乘页数，结果缓存
     
     Returns:
-        combinations: [([url1, url2, ...], metadata), ...] 所有可能的URL组合
+        (组合数, 相乘页数)，没有图像时组合数为 0
     """
-    from itertools import product
-    
-    # 过滤出有图像的页面
-    valid_pages = [(imgs, mode) for imgs, mode in pages_data if imgs]
-    
-    if not valid_pages:
-        return []
-    
-    # 为每个页面准备可能的组合
-    page_combinations = []
-    for images, mode in valid_pages:
+    if not page_shapes:
+        return 0, 0
+    combos = 1
+    multiply_pages = 0
+    for image_count, mode in page_shapes:
         if mode == "相乘":
-            # 相乘：每张图作为一个单独的选项
-            page_combinations.append([[img] for img in images])
-        else:  # 相加
-            # 相加：所有图像作为一个整体
-            page_combinations.append([images])
-    
-    # 计算笛卡尔积
-    all_combinations = []
-    for combo in product(*page_combinations):
-        # combo是一个元组，每个元素是一个图像列表
-        # 合并所有列表
-        merged = []
-        for img_list in combo:
-            merged.extend(img_list)
-        all_combinations.append(merged)
-    
-    return all_combinations
+            combos *= image_count
+            multiply_pages += 1
+    return combos, multiply_pages
 
 
 def parse_prompt_groups(raw_groups):
@@ -1169,7 +2017,7 @@ def parse_prompt_groups(raw_groups):
     for idx, (text, mode, inherit, label) in enumerate(raw_groups, start=1):
         lines = []
         if text:
-            lines = [line.strip() for line in text.strip().split('\n') if line.strip()]
+            lines = split_nonempty_lines(text)
         if not lines:
             if inherit:
                 raise ValueError(f"{label} 启用了继承模式，但没有有效的提示词")
@@ -1224,8 +2072,8 @@ def describe_stage(groups):
     return " + ".join(parts)
 
 
-def build_pipeline_plan(prompt_groups):
-    """根据提示词组构建阶段计划"""
+def split_stage_groups(prompt_groups):
+    """按继承设置把提示词组划分为阶段：继承组单独成阶段，其余相邻组合并"""
     stage_groups = []
     current = []
     for group in prompt_groups:
@@ -1238,10 +2086,14 @@ def build_pipeline_plan(prompt_groups):
             current.append(group)
     if current:
         stage_groups.append(current)
+    return stage_groups
+
 
+def build_pipeline_plan(prompt_groups):
+    """根据提示词组构建阶段计划"""
     stage_plan = []
     stage_index = 0
-    for groups in stage_groups:
+    for groups in split_stage_groups(prompt_groups):
         suffixes = generate_prompt_suffixes_from_groups(groups)
         if not suffixes:
             continue
@@ -1261,6 +2113,48 @@ def build_pipeline_plan(prompt_groups):
     return stage_plan
 
 
+def summarize_prompt_plan(raw_groups):
+    """
+    预估用的提示词阶段概要（不生成提示词组合字符串）
+    
+    Returns:
+        (每个阶段的提示词数量, 相乘提示词组数, 继承提示词组数)
+    
+    Raises:
+        ValueError: 与 parse_prompt_groups / build_pipeline_plan 相同的配置错误
+    """
+    # 阶段结构只取决于各组的有效行数、模式和继承设置
+    group_shapes = tuple(
+        (len(split_nonempty_lines(text)) if text else 0, mode, bool(inherit), label)
+        for text, mode, inherit, label in raw_groups
+    )
+    return _summarize_prompt_plan_cached(group_shapes)
+
+
+@lru_cache(maxsize=64)
+def _summarize_prompt_plan_cached(group_shapes):
+    prompt_groups = []
+    for line_count, mode, inherit, label in group_shapes:
+        if not line_count:
+            if inherit:
+                raise ValueError(f"{label} 启用了继承模式，但没有有效的提示词")
+            continue
+        prompt_groups.append({'line_count': line_count, 'mode': mode, 'inherit': inherit})
+    if not prompt_groups:
+        raise ValueError("请至少输入一个提示词")
+    if prompt_groups[0]['inherit']:
+        raise ValueError("第一个提示词组不能启用继承模式")
+    
+    # 相乘组贡献行数个选项，相加组整体作为一个选项
+    stage_prompt_counts = tuple(
+        math.prod(g['line_count'] if g['mode'] == "相乘" else 1 for g in groups)
+        for groups in split_stage_groups(prompt_groups)
+    )
+    multiply_count = sum(1 for g in prompt_groups if g['mode'] == "相乘")
+    inherit_count = sum(1 for g in prompt_groups if g['inherit'])
+    return stage_prompt_counts, multiply_count, inherit_count
+
+
 def compute_pipeline_statistics(initial_combo_count, stage_plan):
     """计算阶段统计信息并更新阶段配置"""
     stage_summaries = []
@@ -1279,6 +2173,48 @@ def compute_pipeline_statistics(initial_combo_count, stage_plan):
     return total_tasks, stage_summaries, current_inputs
 
 
+@lru_cache(maxsize=128)
+def format_task_estimate(page_shapes, raw_prompt_groups) -> str:
+    """
+    根据各页形状和提示词分组生成预估文本，整段结果按输入缓存
+    
+    Args:
+        page_shapes: ((图像数, 模式), ...) 仅包含有图像的页面
+        raw_prompt_groups: ((文本, 模式, 是否继承, 标签), ...)
+    """
+    total_combos, multiply_count = summarize_page_shapes(page_shapes)
+
+    if not total_combos:
+        return "等待上传图像..."
+
+    # 只按各组行数估算阶段提示词数量
+    try:
+        stage_prompt_counts, prompt_multiply, inherit_count = summarize_prompt_plan(raw_prompt_groups)
+    except ValueError as err:
+        return str(err)
+    except Exception:
+        return "提示词配置无效，请检查"
+
+    stage_plan = [
+        {'stage_index': stage_index, 'prompt_count': prompt_count}
+        for stage_index, prompt_count in enumerate(stage_prompt_counts, start=1)
+    ]
+    total_tasks, stage_summaries, _ = compute_pipeline_statistics(total_combos, stage_plan)
+    stage_summary_text = " | ".join(stage_summaries)
+
+    warning_parts = []
+    if multiply_count >= 2:
+        warning_parts.append(f"{multiply_count}个相乘图像")
+    if prompt_multiply >= 2:
+        warning_parts.append(f"{prompt_multiply}个相乘提示词组")
+    if inherit_count:
+        warning_parts.append(f"{inherit_count}个继承提示词组")
+
+    warning_prefix = f"⚠️ {' · '.join(warning_parts)} | " if warning_parts else ""
+    stage_suffix = f" | {stage_summary_text}" if stage_summary_text else ""
+    return f"{warning_prefix}{total_combos} 组合，预计 {total_tasks} 任务{stage_suffix}"
+
+
 def batch_generate_flexible(
     # 每页的图像和模式
     page1_images, page1_mode,
@@ -1302,16 +2238,16 @@ def batch_generate_flexible(
 ):
     """灵活组合模式的生成函数（支持提示词继承）"""
 
-    if not main_api_key.strip():
-        return "❌ 请输入主API密钥", None, ""
+    # 各文本输入只 strip 一次，后续统一使用
+    main_api_key = main_api_key.strip()
+    backup_api_keys = backup_api_keys.strip() if backup_api_keys else ""
+    output_dir = (output_dir or "").strip() or OUTPUT_DIR
 
-    if not output_dir or not output_dir.strip():
-        output_dir = OUTPUT_DIR
-    else:
-        output_dir = output_dir.strip()
+    if not main_api_key:
+        return "❌ 请输入主API密钥", None, ""
 
     try:
-        os.makedirs(output_dir, exist_ok=True)
+        _ensure_output_dir(output_dir)
     except Exception as e:
         return f"❌ 无法创建输出目录: {str(e)}", None, ""
 
@@ -1325,16 +2261,20 @@ def batch_generate_flexible(
     except ValueError as e:
         return f"❌ {str(e)}", None, ""
 
-    pages_data = [
-        (page1_images if page1_images else [], page1_mode),
-        (page2_images if page2_images else [], page2_mode),
-        (page3_images if page3_images else [], page3_mode),
-        (page4_images if page4_images else [], page4_mode),
-        (page5_images if page5_images else [], page5_mode),
+    # 一次性筛出有图像的页面（复制为元组，后台展开组合时不受界面后续修改影响）
+    valid_pages = [
+        (tuple(imgs), mode) for imgs, mode in (
+            (page1_images, page1_mode),
+            (page2_images, page2_mode),
+            (page3_images, page3_mode),
+            (page4_images, page4_mode),
+            (page5_images, page5_mode),
+        ) if imgs
     ]
 
-    combinations = calculate_image_combinations(pages_data)
-    if not combinations:
+    # 提交时只按页面形状计算组合数，组合本身由后台线程展开，大批量相乘时不阻塞界面
+    initial_combo_count = summarize_page_shapes(tuple((len(imgs), mode) for imgs, mode in valid_pages))[0]
+    if not initial_combo_count:
         return "❌ 请至少上传一张图像", None, ""
 
     try:
@@ -1342,7 +2282,6 @@ def batch_generate_flexible(
     except ValueError as e:
         return f"❌ {str(e)}", None, ""
 
-    initial_combo_count = len(combinations)
     total_tasks, stage_summaries, _ = compute_pipeline_statistics(initial_combo_count, stage_plan)
     if total_tasks == 0:
         return "❌ 无法计算任务数，请检查提示词输入", None, ""
@@ -1350,31 +2289,24 @@ def batch_generate_flexible(
     # 移除二次确认逻辑，直接开始任务
     # 任务数量较多时会在预估框显示警告，用户可自行查看
 
-    all_api_keys = [main_api_key.strip()]
-    if use_multiple_accounts and backup_api_keys.strip():
-        backup_keys = [k.strip() for k in backup_api_keys.strip().split('\n') if k.strip()]
-        all_api_keys.extend(backup_keys)
+    all_api_keys = build_api_key_list(main_api_key, backup_api_keys, use_multiple_accounts)
 
-    group_id = str(uuid.uuid4())
+    group_id = new_task_group_id()
 
     register_task_group_for_cancel(group_id)
 
-    thread = threading.Thread(
-        target=process_flexible_combinations_async,
-        args=(
-            group_id,
-            combinations,
-            stage_plan,
-            all_api_keys,
-            max_workers,
-            model,
-            aspect_ratio,
-            max_retries,
-            output_dir
-        ),
-        daemon=True
+    submit_task_group(
+        process_flexible_combinations_async,
+        group_id,
+        valid_pages,
+        stage_plan,
+        all_api_keys,
+        max_workers,
+        model,
+        aspect_ratio,
+        max_retries,
+        output_dir
     )
-    thread.start()
 
     stage_breakdown = "\n".join(stage_summaries)
     success_msg = (
@@ -1412,37 +2344,35 @@ def batch_generate_unified(
 ):
     """统一的生成函数：根据模式调用不同的处理逻辑"""
     
+    # 各文本输入只 strip 一次，后续统一使用
+    prompts_text = prompts_text.strip()
+    main_api_key = main_api_key.strip()
+    backup_api_keys = backup_api_keys.strip() if backup_api_keys else ""
+    output_dir = (output_dir or "").strip() or OUTPUT_DIR
+    
     # 验证提示词
-    if not prompts_text.strip():
+    if not prompts_text:
         return "❌ 请输入提示词", None, ""
     
-    if not main_api_key.strip():
+    if not main_api_key:
         return "❌ 请输入主API密钥", None, ""
     
-    # 验证并创建输出目录
-    if not output_dir or not output_dir.strip():
-        output_dir = OUTPUT_DIR
-    else:
-        output_dir = output_dir.strip()
-    
+    # 创建输出目录
     try:
-        os.makedirs(output_dir, exist_ok=True)
+        _ensure_output_dir(output_dir)
     except Exception as e:
         return f"❌ 无法创建输出目录: {str(e)}", None, ""
     
     # 解析提示词
-    prompts = [line.strip() for line in prompts_text.strip().split('\n') if line.strip()]
+    prompts = split_nonempty_lines(prompts_text)
     if not prompts:
         return "❌ 请输入有效的提示词", None, ""
     
     # 准备API密钥列表
-    all_api_keys = [main_api_key.strip()]
-    if use_multiple_accounts and backup_api_keys.strip():
-        backup_keys = [k.strip() for k in backup_api_keys.strip().split('\n') if k.strip()]
-        all_api_keys.extend(backup_keys)
+    all_api_keys = build_api_key_list(main_api_key, backup_api_keys, use_multiple_accounts)
     
     # 生成任务组ID
-    group_id = str(uuid.uuid4())
+    group_id = new_task_group_id()
     register_task_group_for_cancel(group_id)
     
     if mode == "单图模式":
@@ -1450,22 +2380,18 @@ def batch_generate_unified(
         if not single_images:
             return "❌ 请上传至少一张图像", None, ""
         
-        thread = threading.Thread(
-            target=process_task_group_async,
-            args=(
-                group_id,
-                single_images,
-                prompts,
-                all_api_keys,
-                max_workers,
-                model,
-                aspect_ratio,
-                max_retries,
-                output_dir
-            ),
-            daemon=True
+        submit_task_group(
+            process_task_group_async,
+            group_id,
+            single_images,
+            prompts,
+            all_api_keys,
+            max_workers,
+            model,
+            aspect_ratio,
+            max_retries,
+            output_dir
         )
-        thread.start()
         
         image_count = len(single_images) if isinstance(single_images, list) else 1
         total_tasks = image_count * len(prompts)
@@ -1493,22 +2419,18 @@ def batch_generate_unified(
         if not page_images_dict:
             return "❌ 请至少在一个页面上传图像", None, ""
         
-        thread = threading.Thread(
-            target=process_multi_group_async,
-            args=(
-                group_id,
-                page_images_dict,
-                prompts,
-                all_api_keys,
-                max_workers,
-                model,
-                aspect_ratio,
-                max_retries,
-                output_dir
-            ),
-            daemon=True
+        submit_task_group(
+            process_multi_group_async,
+            group_id,
+            page_images_dict,
+            prompts,
+            all_api_keys,
+            max_workers,
+            model,
+            aspect_ratio,
+            max_retries,
+            output_dir
         )
-        thread.start()
         
         total_pages = len(page_images_dict)
         total_images = sum(len(imgs) for imgs in page_images_dict.values() if imgs)
@@ -1522,53 +2444,152 @@ def batch_generate_unified(
 
 
 def get_current_status():
-    """获取所有任务组的当前状态"""
-    status_lines = []
+    """获取所有任务组的当前状态，任务组和输出均无变化时返回上次结果"""
+    # 先读取版本号再构建，构建期间的更新会在下一次轮询时体现
+    _drain_pending_outputs()
+    versions = (task_groups_version, all_output_version)
+    cached_versions, cached_status = _status_cache['entry']
+    if versions == cached_versions:
+        return cached_status
     
-    with task_groups_lock:
-        if not task_groups:
-            return "暂无任务", None, ""
-        
-        # 统计所有任务组（显示最近3个）
-        for group_id, info in list(task_groups.items())[-3:]:
-            status_lines.append(f"[{group_id[:8]}] {info['status']}")
-            status_lines.append(f"上传: {info['upload_progress']} | API: {info['api_progress']}")
+    status = _build_current_status()
+    _status_cache['entry'] = (versions, status)
+    return status
+
+
+def poll_current_status(last_versions):
+    """
+    定时轮询用的状态获取，只推送本会话上次之后有变化的部分
     
-    # 获取所有输出文件（包含元数据）
-    with all_output_files_lock:
-        output_files_with_metadata = all_output_files.copy()
+    Args:
+        last_versions: 本会话上次推送时的 (任务组版本, 输出版本)，首次为 None
     
-    # 构建带标题的图像列表（简化标题）
-    # Gradio Gallery 格式: [(图像路径, 标题), ...]
-    gallery_images = []
-    for file_path, metadata in output_files_with_metadata:
-        if metadata:
-            upload_time = metadata.get('upload_time', 0)
-            api_time = metadata.get('api_time', 0)
-            total_time = metadata.get('total_time', 0)
-            
-            # 简化标题：只显示时间
-            caption = f"上传: {upload_time:.1f}s | API: {api_time:.1f}s | 总计: {total_time:.1f}s"
-            
-            gallery_images.append((file_path, caption))
-        else:
-            gallery_images.append((file_path, ""))
+    Returns:
+        (状态, 画廊, 日志, 新的版本号, 本会话画廊列表)，未变化的部分为 gr.update()；
+        画廊列表与推送给画廊的值相同，点击图像时按它解析索引，不受其他会话或之后新增输出的影响。
+        定时器一直运行（其他会话提交的任务组也要能看到），无变化时只返回几个空更新
+    """
+    _drain_pending_outputs()
+    versions = (task_groups_version, all_output_version)
+    if versions == last_versions:
+        return gr.update(), gr.update(), gr.update(), last_versions, gr.update()
+    
+    summary, gallery_images, log_text = get_current_status()
+    groups_changed = last_versions is None or versions[0] != last_versions[0]
+    outputs_changed = last_versions is None or versions[1] != last_versions[1]
+    return (
+        summary if groups_changed else gr.update(),
+        gallery_images if outputs_changed else gr.update(),
+        log_text if groups_changed else gr.update(),
+        versions,
+        gallery_images if outputs_changed else gr.update()
+    )
+
+
+def refresh_current_status():
+    """手动刷新：完整推送一次当前状态，并记下版本号，之后的定时轮询不会重复推送同样的内容"""
+    return poll_current_status(None)
+
+
+def clear_all_outputs():
+    """清空所有输出结果"""
+    global all_output_files, image_metadata, task_groups
+    global all_output_version, task_groups_version
+    
+    # 已入队但尚未合并的输出一并清空
+    _drain_pending_outputs()
+    
+    # 锁内只替换为新的空容器，旧容器在锁外释放，不阻塞状态轮询；
+    # 输出列表和元数据在同一临界区内替换（锁顺序与 _drain_pending_outputs 一致），
+    # 清空期间合并进来的新输出不会把元数据写进即将丢弃的旧字典
+    with _gallery_cache_lock, all_output_files_lock:
+        old_output_files = all_output_files
+        old_gallery_items = _gallery_cache['items']
+        all_output_files = deque(maxlen=MAX_GALLERY_OUTPUTS)
+        _gallery_cache['items'] = deque(maxlen=MAX_GALLERY_OUTPUTS)
+        _gallery_cache['value'] = None
+        all_output_version += 1
+        with image_metadata_lock:
+            old_image_metadata = image_metadata
+            image_metadata = OrderedDict()
+            _prompt_pool.clear()
     
-    # 获取最后一个任务组的日志
     with task_groups_lock:
-        if task_groups:
-            last_log = list(task_groups.values())[-1].get('log', [])
-            log_text = "\n".join(last_log[-50:])  # 最后50行
-        else:
-            log_text = ""
+        old_task_groups = task_groups
+        task_groups = defaultdict(dict)
+        recent_groups.clear()
+        task_groups_version = next(_task_groups_versions)
+    
+    # 画廊原本就是空的时不再回传空画廊，避免前端无谓地重新渲染；本会话的画廊列表随画廊一起清空
+    gallery_update = None if old_output_files or old_gallery_items else gr.update()
+    del old_output_files, old_gallery_items, old_image_metadata, old_task_groups
+    prune_thumbnail_dir()
+    
+    return "✅ 已清空所有输出", gallery_update, "", gallery_update
+
+
+def _build_current_status():
+    """构建状态文本、画廊和日志（锁内只取快照，格式化在锁外进行）"""
+    # 最近3个任务组的状态快照及最后一个任务组的日志，每组只取一次自己的锁，不阻塞其他任务组更新
+    groups = list(recent_groups)
+    last_log = ()
+    status_lines = []
+    for index, (group_id, info) in enumerate(groups, 1):
+        status, upload_progress, api_progress, log = _task_group_snapshot(info, with_log=index == len(groups))
+        if log:
+            last_log = log
+        status_lines.append(f"[{group_id[:8]}] {status}")
+        status_lines.append(f"上传: {upload_progress} | API: {api_progress}")
+    
+    # 构建带标题的图像列表，只为新增的输出生成标题
+    # Gradio Gallery 格式: [(图像路径, 标题), ...]
+    with _gallery_cache_lock:
+        # 输出列表锁内只复制新增的尾部，不阻塞生成线程追加结果
+        with all_output_files_lock:
+            version = all_output_version
+            new_count = min(version - _gallery_cache['version'], len(all_output_files))
+            new_entries = list(islice(reversed(all_output_files), new_count))[::-1] if new_count > 0 else []
+        if new_entries:
+            items = _gallery_cache['items']
+            items.extend((file_path, _format_gallery_caption(metadata)) for file_path, metadata in new_entries)
+            _gallery_cache['value'] = list(items)
+        _gallery_cache['version'] = version
+        gallery_images = _gallery_cache['value']
+    
+    log_text = "\n".join(last_log)  # 日志本身只保留最后50行
+    
+    # 日志框只显示末尾窗口，从完整行开始截取
+    if len(log_text) > MAX_LOG_TEXT_CHARS:
+        tail = log_text[-MAX_LOG_TEXT_CHARS:]
+        newline_pos = tail.find("\n")
+        log_text = tail[newline_pos + 1:] if newline_pos != -1 else tail
     
     return (
-        "\n".join(status_lines),
+        "\n".join(status_lines) if status_lines else "暂无任务",
         gallery_images if gallery_images else None,
         log_text
     )
 
 
+HELP_MARKDOWN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "WEBUI_HELP.md")
+
+
+def load_help_markdown() -> str:
+    """读取界面底部的使用说明（WEBUI_HELP.md），文件缺失时给出提示而不影响启动"""
+    try:
+        return Path(HELP_MARKDOWN_PATH).read_text(encoding="utf-8")
+    except OSError:
+        return "⚠️ 未找到使用说明文件 WEBUI_HELP.md"
+
+
+# 多图分组模式的图像页数量（与 batch_generate_flexible 的页面参数一致）
+NUM_IMAGE_PAGES = 5
+
+# 事件并发组：只读事件（状态轮询、预估、查看）很快，提交事件只负责入队
+READ_CONCURRENCY_LIMIT = 16
+SUBMIT_CONCURRENCY_LIMIT = 4
+QUEUE_MAX_SIZE = 256  # 排队事件上限，过载时新请求直接提示繁忙，而不是无限积压
+
 # 创建 Gradio 界面
 with gr.Blocks(title="Banana 图像生成", theme=gr.themes.Soft()) as demo:
     # 标题栏
@@ -1631,6 +2652,8 @@ with gr.Blocks(title="Banana 图像生成", theme=gr.themes.Soft()) as demo:
     
     # 自动刷新定时器（每2秒）
     auto_refresh = gr.Timer(value=2)
+    status_versions = gr.State(None)  # 本会话最近一次推送的状态版本号
+    shown_gallery = gr.State(None)  # 本会话画廊当前显示的 [(路径, 标题)]，点击图像时按它解析索引
     
     # 多账户切换显示备用密钥输入框
     def toggle_backup_keys(use_multi):
@@ -1646,145 +2669,42 @@ with gr.Blocks(title="Banana 图像生成", theme=gr.themes.Soft()) as demo:
         with gr.Column(scale=1):
             # 多页面图像上传区域
             with gr.Tabs() as image_tabs:
-                # 图像1（默认相乘）
-                with gr.Tab("📄 图像1", id=1) as tab1:
-                    with gr.Row():
-                        with gr.Column(scale=1, min_width=150):
-                            page1_mode = gr.Radio(
-                                choices=["相乘", "相加"],
-                                value="相乘",
-                                label="🔧 组合方式"
-                            )
-                        with gr.Column(scale=3):
-                            page1_upload = gr.File(
-                                label="上传图像",
-                                file_count="multiple",
-                                file_types=["image"],
-                                type="filepath",
-                                height=150
-                            )
-                    page1_gallery = gr.Gallery(
-                        label="图像1 - 已上传图像",
-                        columns=4,
-                        rows=3,
-                        height=600,
-                        object_fit="scale-down"
-                    )
-                    with gr.Row():
-                        page1_delete_btn = gr.Button("❌ 删除所选", size="sm")
-                        page1_clear_btn = gr.Button("🗑️ 清空", size="sm")
-                
-                # 图像2（默认相加）
-                with gr.Tab("📄 图像2", id=2) as tab2:
-                    with gr.Row():
-                        with gr.Column(scale=1, min_width=150):
-                            page2_mode = gr.Radio(
-                                choices=["相乘", "相加"],
-                                value="相乘",
-                                label="🔧 组合方式"
-                            )
-                        with gr.Column(scale=3):
-                            page2_upload = gr.File(
-                                label="上传图像",
-                                file_count="multiple",
-                                file_types=["image"],
-                                type="filepath",
-                                height=150
-                            )
-                    page2_gallery = gr.Gallery(
-                        label="图像2 - 已上传图像",
-                        columns=4,
-                        rows=3,
-                        height=600,
-                        object_fit="scale-down"
-                    )
-                    with gr.Row():
-                        page2_delete_btn = gr.Button("❌ 删除所选", size="sm")
-                        page2_clear_btn = gr.Button("🗑️ 清空", size="sm")
-                
-                # 图像3（默认相加）
-                with gr.Tab("📄 图像3", id=3) as tab3:
-                    with gr.Row():
-                        with gr.Column(scale=1, min_width=150):
-                            page3_mode = gr.Radio(
-                                choices=["相乘", "相加"],
-                                value="相乘",
-                                label="🔧 组合方式"
-                            )
-                        with gr.Column(scale=3):
-                            page3_upload = gr.File(
-                                label="上传图像",
-                                file_count="multiple",
-                                file_types=["image"],
-                                type="filepath",
-                                height=150 
-                            )
-                    page3_gallery = gr.Gallery(
-                        label="图像3 - 已上传图像",
-                        columns=4,
-                        rows=3,
-                        height=600,
-                        object_fit="scale-down"
-                    )
-                    with gr.Row():
-                        page3_delete_btn = gr.Button("❌ 删除所选", size="sm")
-                        page3_clear_btn = gr.Button("🗑️ 清空", size="sm")
-                
-                # 图像4（默认相加）
-                with gr.Tab("📄 图像4", id=4) as tab4:
-                    with gr.Row():
-                        with gr.Column(scale=1, min_width=150):
-                            page4_mode = gr.Radio(
-                                choices=["相乘", "相加"],
-                                value="相乘",
-                                label="🔧 组合方式"
-                            )
-                        with gr.Column(scale=3):
-                            page4_upload = gr.File(
-                                label="上传图像",
-                                file_count="multiple",
-                                file_types=["image"],
-                                type="filepath",
-                                height=150
-                            )
-                    page4_gallery = gr.Gallery(
-                        label="图像4 - 已上传图像",
-                        columns=4,
-                        rows=3,
-                        height=600,
-                        object_fit="scale-down"
-                    )
-                    with gr.Row():
-                        page4_delete_btn = gr.Button("❌ 删除所选", size="sm")
-                        page4_clear_btn = gr.Button("🗑️ 清空", size="sm")
-                
-                # 图像5（默认相加）
-                with gr.Tab("📄 图像5", id=5) as tab5:
-                    with gr.Row():
-                        with gr.Column(scale=1, min_width=150):
-                            page5_mode = gr.Radio(
-                                choices=["相乘", "相加"],
-                                value="相乘",
-                                label="🔧 组合方式"
-                            )
-                        with gr.Column(scale=3):
-                            page5_upload = gr.File(
-                                label="上传图像",
-                                file_count="multiple",
-                                file_types=["image"],
-                                type="filepath",
-                                height=150
-                            )
-                    page5_gallery = gr.Gallery(
-                        label="图像5 - 已上传图像",
-                        columns=4,
-                        rows=3,
-                        height=600,
-                        object_fit="scale-down"
-                    )
-                    with gr.Row():
-                        page5_delete_btn = gr.Button("❌ 删除所选", size="sm")
-                        page5_clear_btn = gr.Button("🗑️ 清空", size="sm")
+                # 各图像页结构相同（默认相乘），循环生成；组件按页存入 image_pages
+                image_pages = []
+                for page_num in range(1, NUM_IMAGE_PAGES + 1):
+                    with gr.Tab(f"📄 图像{page_num}", id=page_num):
+                        with gr.Row():
+                            with gr.Column(scale=1, min_width=150):
+                                page_mode = gr.Radio(
+                                    choices=["相乘", "相加"],
+                                    value="相乘",
+                                    label="🔧 组合方式"
+                                )
+                            with gr.Column(scale=3):
+                                page_upload = gr.File(
+                                    label="上传图像",
+                                    file_count="multiple",
+                                    file_types=["image"],
+                                    type="filepath",
+                                    height=150
+                                )
+                        page_gallery = gr.Gallery(
+                            label=f"图像{page_num} - 已上传图像",
+                            columns=4,
+                            rows=3,
+                            height=600,
+                            object_fit="scale-down"
+                        )
+                        with gr.Row():
+                            page_delete_btn = gr.Button("❌ 删除所选", size="sm")
+                            page_clear_btn = gr.Button("🗑️ 清空", size="sm")
+                    image_pages.append({
+                        'mode': page_mode,
+                        'upload': page_upload,
+                        'gallery': page_gallery,
+                        'delete_btn': page_delete_btn,
+                        'clear_btn': page_clear_btn
+                    })
             
             # ========== 提示词分组区域 ==========
             with gr.Tabs() as prompt_tabs:
@@ -1906,134 +2826,70 @@ with gr.Blocks(title="Banana 图像生成", theme=gr.themes.Soft()) as demo:
     selected_image_path = gr.State(None)
     selected_preview_index = gr.State(None)  # 记录预览选中的索引
     
-    # 多图分组模式状态
-    page1_files = gr.State([])  # 图像1的图像列表
-    page2_files = gr.State([])  # 图像2的图像列表
-    page3_files = gr.State([])  # 图像3的图像列表
-    page4_files = gr.State([])  # 图像4的图像列表
-    page5_files = gr.State([])  # 图像5的图像列表
-    page1_selected_idx = gr.State(None)
-    page2_selected_idx = gr.State(None)
-    page3_selected_idx = gr.State(None)
-    page4_selected_idx = gr.State(None)
-    page5_selected_idx = gr.State(None)
+    # 多图分组模式状态：每页的图像列表及选中的索引
+    for page in image_pages:
+        page['files'] = gr.State([])
+        page['selected_idx'] = gr.State(None)
+    # 各页的 (图像列表, 组合方式)，按页顺序展开，供预估和生成共用
+    page_inputs = [component for page in image_pages for component in (page['files'], page['mode'])]
     
     # 预估任务数计算函数
     def calculate_task_estimate(*args):
         """实时计算预估任务数，容忍缺失输入"""
-        expected_len = 19
+        page_arg_count = NUM_IMAGE_PAGES * 2
+        expected_len = page_arg_count + 9
         if not args or len(args) < expected_len:
             return "等待上传图像..."
 
+        page_args = args[:page_arg_count]
         (
-            p1_imgs, p1_mode, p2_imgs, p2_mode, p3_imgs, p3_mode,
-            p4_imgs, p4_mode, p5_imgs, p5_mode,
             g1_text, g1_mode, g1_inherit,
             g2_text, g2_mode, g2_inherit,
             g3_text, g3_mode, g3_inherit
-        ) = args[:expected_len]
-
-        pages_data = [
-            (p1_imgs if p1_imgs else [], p1_mode),
-            (p2_imgs if p2_imgs else [], p2_mode),
-            (p3_imgs if p3_imgs else [], p3_mode),
-            (p4_imgs if p4_imgs else [], p4_mode),
-            (p5_imgs if p5_imgs else [], p5_mode),
-        ]
-        
-        combinations = calculate_image_combinations(pages_data)
-
-        if not combinations:
-            return "等待上传图像..."
+        ) = args[page_arg_count:expected_len]
 
-        raw_prompt_groups = [
+        # 预估只需要各页的图像数和模式，无需展开笛卡尔积
+        page_shapes = tuple(
+            (len(imgs), mode) for imgs, mode in zip(page_args[::2], page_args[1::2]) if imgs
+        )
+        raw_prompt_groups = (
             (g1_text, g1_mode, bool(g1_inherit), "提示词组1"),
             (g2_text, g2_mode, bool(g2_inherit), "提示词组2"),
             (g3_text, g3_mode, bool(g3_inherit), "提示词组3"),
-        ]
-
-        try:
-            prompt_groups = parse_prompt_groups(raw_prompt_groups)
-            stage_plan = build_pipeline_plan(prompt_groups)
-        except ValueError as err:
-            return str(err)
-        except Exception:
-            return "提示词配置无效，请检查"
-
-        total_combos = len(combinations)
-        total_tasks, stage_summaries, _ = compute_pipeline_statistics(total_combos, stage_plan)
-        stage_summary_text = " | ".join(stage_summaries)
-
-        # 检查相乘图像数
-        multiply_count = sum(1 for imgs, mode in pages_data if imgs and mode == "相乘")
-        prompt_multiply = sum(1 for group in prompt_groups if group['mode'] == "相乘")
-        inherit_count = sum(1 for group in prompt_groups if group['inherit'])
-
-        warning_parts = []
-        if multiply_count >= 2:
-            warning_parts.append(f"{multiply_count}个相乘图像")
-        if prompt_multiply >= 2:
-            warning_parts.append(f"{prompt_multiply}个相乘提示词组")
-        if inherit_count:
-            warning_parts.append(f"{inherit_count}个继承提示词组")
-
-        warning_prefix = f"⚠️ {' · '.join(warning_parts)} | " if warning_parts else ""
-        stage_suffix = f" | {stage_summary_text}" if stage_summary_text else ""
-        return f"{warning_prefix}{total_combos} 组合，预计 {total_tasks} 任务{stage_suffix}"
+        )
+        return format_task_estimate(page_shapes, raw_prompt_groups)
     
     # 添加图像到列表（追加模式）
-    def add_images(existing_files, new_files):
-        """追加新图像到列表"""
-        if existing_files is None:
-            existing_files = []
-        
-        if not new_files:
-            return existing_files, existing_files, None
-        
-        # 处理新上传的文件
+    def append_new_files(existing_files, new_files):
+        """把新上传的文件路径原地追加到列表（按集合去重，已有的路径跳过），返回新增数量"""
+        seen = set(existing_files)
+        original_count = len(existing_files)
         for f in new_files:
-            file_path = None
-            if isinstance(f, str):
-                file_path = f
-            elif hasattr(f, 'name'):
-                file_path = f.name
-            
-            # 避免重复
-            if file_path and file_path not in existing_files:
+            file_path = f if isinstance(f, str) else getattr(f, 'name', None)
+            if file_path and file_path not in seen:
+                seen.add(file_path)
                 existing_files.append(file_path)
-        
-        # 返回：更新状态，更新预览，清空输入框（允许继续上传）
-        return existing_files, existing_files, None
+        return len(existing_files) - original_count
     
-    def clear_all_images():
-        """清空所有图像"""
-        return [], [], None
-    
-    def on_preview_select(evt: gr.SelectData, files_list):
-        """记录预览中选中的图像索引"""
-        if evt.index is not None and files_list and evt.index < len(files_list):
-            return evt.index
-        return None
-    
-    def delete_selected_from_preview(selected_idx, files_list):
-        """删除预览中选中的图像，并智能更新选中索引"""
+    def delete_selected_image(selected_idx, files_list):
+        """删除图像页中选中的图像，并智能更新选中索引"""
         if selected_idx is None or not files_list or selected_idx >= len(files_list):
-            return files_list, files_list, None
+            return files_list, gallery_thumbnails(files_list or []), None
         
-        # 删除选中的图像
-        new_list = files_list[:selected_idx] + files_list[selected_idx + 1:]
+        # 原地删除选中的图像（与追加图像一致，不复制列表）
+        del files_list[selected_idx]
         
         # 智能更新选中索引：
         # 如果删除后还有图像，选中下一张（或最后一张）
-        if new_list:
+        if files_list:
             # 如果删除的不是最后一张，保持当前索引（指向下一张）
             # 如果删除的是最后一张，选中新的最后一张
-            new_selected_idx = selected_idx if selected_idx < len(new_list) else len(new_list) - 1
+            new_selected_idx = min(selected_idx, len(files_list) - 1)
         else:
             # 列表为空，清空选中
             new_selected_idx = None
         
-        return new_list, new_list, new_selected_idx
+        return files_list, gallery_thumbnails(files_list), new_selected_idx
     
     # ========== 多图像图像管理函数 ==========
     def add_images_to_page(existing_files, new_files):
@@ -2041,24 +2897,20 @@ with gr.Blocks(title="Banana 图像生成", theme=gr.themes.Soft()) as demo:
         if existing_files is None:
             existing_files = []
         
+        # 没有新文件时不回传列表，避免重复序列化整个画廊
         if not new_files:
-            return existing_files, existing_files, None
+            return gr.update(), gr.update(), None
         
-        for f in new_files:
-            file_path = None
-            if isinstance(f, str):
-                file_path = f
-            elif hasattr(f, 'name'):
-                file_path = f.name
-            
-            if file_path and file_path not in existing_files:
-                existing_files.append(file_path)
+        if not append_new_files(existing_files, new_files):
+            return gr.update(), gr.update(), None
         
-        return existing_files, existing_files, None
+        return existing_files, gallery_thumbnails(existing_files), None
+    
+    _EMPTY_GALLERY = ()  # 清空画廊用的只读值；页面文件状态会被原地追加，仍需返回新列表
     
     def clear_page_images():
         """清空某页的所有图像"""
-        return [], [], None
+        return [], _EMPTY_GALLERY, None
     
     def on_page_select(evt: gr.SelectData, files_list):
         """记录页面中选中的图像索引"""
@@ -2066,206 +2918,66 @@ with gr.Blocks(title="Banana 图像生成", theme=gr.themes.Soft()) as demo:
             return evt.index
         return None
     
-    def delete_selected_from_page(selected_idx, files_list):
-        """从页面删除选中的图像"""
-        if selected_idx is None or not files_list or selected_idx >= len(files_list):
-            return files_list, files_list, None
-        
-        new_list = files_list[:selected_idx] + files_list[selected_idx + 1:]
+    # ========== 多图分组模式事件绑定 ==========
+    # 各图像页的事件完全相同，循环注册
+    for page in image_pages:
+        page['upload'].upload(
+            fn=add_images_to_page,
+            inputs=[page['files'], page['upload']],
+            outputs=[page['files'], page['gallery'], page['upload']]
+        )
         
-        if new_list:
-            new_selected_idx = selected_idx if selected_idx < len(new_list) else len(new_list) - 1
-        else:
-            new_selected_idx = None
+        page['gallery'].select(
+            fn=on_page_select,
+            inputs=[page['files']],
+            outputs=[page['selected_idx']]
+        )
         
-        return new_list, new_list, new_selected_idx
-    
-    # ========== 多图分组模式事件绑定 ==========
-    # 图像1
-    page1_upload.upload(
-        fn=add_images_to_page,
-        inputs=[page1_files, page1_upload],
-        outputs=[page1_files, page1_gallery, page1_upload]
-    )
-    
-    page1_gallery.select(
-        fn=on_page_select,
-        inputs=[page1_files],
-        outputs=[page1_selected_idx]
-    )
-    
-    page1_delete_btn.click(
-        fn=delete_selected_from_page,
-        inputs=[page1_selected_idx, page1_files],
-        outputs=[page1_files, page1_gallery, page1_selected_idx]
-    )
-    
-    page1_clear_btn.click(
-        fn=clear_page_images,
-        outputs=[page1_files, page1_gallery, page1_upload]
-    )
-    
-    # 图像2
-    page2_upload.upload(
-        fn=add_images_to_page,
-        inputs=[page2_files, page2_upload],
-        outputs=[page2_files, page2_gallery, page2_upload]
-    )
-    
-    page2_gallery.select(
-        fn=on_page_select,
-        inputs=[page2_files],
-        outputs=[page2_selected_idx]
-    )
-    
-    page2_delete_btn.click(
-        fn=delete_selected_from_page,
-        inputs=[page2_selected_idx, page2_files],
-        outputs=[page2_files, page2_gallery, page2_selected_idx]
-    )
-    
-    page2_clear_btn.click(
-        fn=clear_page_images,
-        outputs=[page2_files, page2_gallery, page2_upload]
-    )
-    
-    # 图像3
-    page3_upload.upload(
-        fn=add_images_to_page,
-        inputs=[page3_files, page3_upload],
-        outputs=[page3_files, page3_gallery, page3_upload]
-    )
-    
-    page3_gallery.select(
-        fn=on_page_select,
-        inputs=[page3_files],
-        outputs=[page3_selected_idx]
-    )
-    
-    page3_delete_btn.click(
-        fn=delete_selected_from_page,
-        inputs=[page3_selected_idx, page3_files],
-        outputs=[page3_files, page3_gallery, page3_selected_idx]
-    )
-    
-    page3_clear_btn.click(
-        fn=clear_page_images,
-        outputs=[page3_files, page3_gallery, page3_upload]
-    )
-    
-    # 图像4
-    page4_upload.upload(
-        fn=add_images_to_page,
-        inputs=[page4_files, page4_upload],
-        outputs=[page4_files, page4_gallery, page4_upload]
-    )
-    
-    page4_gallery.select(
-        fn=on_page_select,
-        inputs=[page4_files],
-        outputs=[page4_selected_idx]
-    )
-    
-    page4_delete_btn.click(
-        fn=delete_selected_from_page,
-        inputs=[page4_selected_idx, page4_files],
-        outputs=[page4_files, page4_gallery, page4_selected_idx]
-    )
-    
-    page4_clear_btn.click(
-        fn=clear_page_images,
-        outputs=[page4_files, page4_gallery, page4_upload]
-    )
-    
-    # 图像5
-    page5_upload.upload(
-        fn=add_images_to_page,
-        inputs=[page5_files, page5_upload],
-        outputs=[page5_files, page5_gallery, page5_upload]
-    )
-    
-    page5_gallery.select(
-        fn=on_page_select,
-        inputs=[page5_files],
-        outputs=[page5_selected_idx]
-    )
-    
-    page5_delete_btn.click(
-        fn=delete_selected_from_page,
-        inputs=[page5_selected_idx, page5_files],
-        outputs=[page5_files, page5_gallery, page5_selected_idx]
-    )
-    
-    page5_clear_btn.click(
-        fn=clear_page_images,
-        outputs=[page5_files, page5_gallery, page5_upload]
-    )
-    
-    # ========== 实时任务数预估 ==========
-    # 绑定所有影响任务数的输入
-    for page_files, page_mode in [
-        (page1_files, page1_mode), (page2_files, page2_mode),
-        (page3_files, page3_mode), (page4_files, page4_mode),
-        (page5_files, page5_mode)
-    ]:
-        page_files.change(
-            fn=calculate_task_estimate,
-            inputs=[
-                page1_files, page1_mode, page2_files, page2_mode,
-                page3_files, page3_mode, page4_files, page4_mode,
-                page5_files, page5_mode,
-                prompt1_text, prompt1_mode, prompt1_inherit,
-                prompt2_text, prompt2_mode, prompt2_inherit,
-                prompt3_text, prompt3_mode, prompt3_inherit
-            ],
-            outputs=[task_estimate]
+        page['delete_btn'].click(
+            fn=delete_selected_image,
+            inputs=[page['selected_idx'], page['files']],
+            outputs=[page['files'], page['gallery'], page['selected_idx']]
         )
-        page_mode.change(
-            fn=calculate_task_estimate,
-            inputs=[
-                page1_files, page1_mode, page2_files, page2_mode,
-                page3_files, page3_mode, page4_files, page4_mode,
-                page5_files, page5_mode,
-                prompt1_text, prompt1_mode, prompt1_inherit,
-                prompt2_text, prompt2_mode, prompt2_inherit,
-                prompt3_text, prompt3_mode, prompt3_inherit
-            ],
-            outputs=[task_estimate]
+        
+        page['clear_btn'].click(
+            fn=clear_page_images,
+            outputs=[page['files'], page['gallery'], page['upload']]
         )
     
-        for prompt_component in [
-            prompt1_text,
-            prompt2_text, prompt2_mode, prompt2_inherit,
-            prompt3_text, prompt3_mode, prompt3_inherit
-        ]:
-            if hasattr(prompt_component, "change"):
-                prompt_component.change(
-                    fn=calculate_task_estimate,
-                    inputs=[
-                        page1_files, page1_mode, page2_files, page2_mode,
-                        page3_files, page3_mode, page4_files, page4_mode,
-                        page5_files, page5_mode,
-                        prompt1_text, prompt1_mode, prompt1_inherit,
-                        prompt2_text, prompt2_mode, prompt2_inherit,
-                        prompt3_text, prompt3_mode, prompt3_inherit
-                    ],
-                    outputs=[task_estimate]
-                )
+    # ========== 实时任务数预估 ==========
+    # 所有绑定共用同一份输入列表（顺序与 calculate_task_estimate 及 batch_generate_flexible 的前几个参数一致）
+    # 三组提示词的 (文本, 模式, 继承) 按组顺序展开，预估、生成和重排共用同一份列表
+    prompt_components = [
+        prompt1_text, prompt1_mode, prompt1_inherit,
+        prompt2_text, prompt2_mode, prompt2_inherit,
+        prompt3_text, prompt3_mode, prompt3_inherit
+    ]
+    estimate_inputs = page_inputs + prompt_components
+    
+    # 各页图像和组合方式、提示词及其模式和继承选项共用一个事件处理，估算很快（结果按输入形状缓存），不显示进度动画；
+    # always_last：估算进行中又有变化（如连续输入提示词）时只保留最后一次，不会停留在旧文本的结果上
+    estimate_triggers = [page['files'] for page in image_pages] + [page['mode'] for page in image_pages] + [
+        prompt1_text,
+        prompt2_text, prompt2_mode, prompt2_inherit,
+        prompt3_text, prompt3_mode, prompt3_inherit
+    ]
+    gr.on(
+        triggers=[trigger.change for trigger in estimate_triggers],
+        fn=calculate_task_estimate,
+        inputs=estimate_inputs,
+        outputs=[task_estimate],
+        show_progress="hidden",
+        trigger_mode="always_last",
+        concurrency_id="read",
+        concurrency_limit=READ_CONCURRENCY_LIMIT
+    )
     
     # ========== 生成按钮事件 ==========
     generate_btn.click(
         fn=batch_generate_flexible,
         inputs=[
-            # 每页的图像和模式
-            page1_files, page1_mode,
-            page2_files, page2_mode,
-            page3_files, page3_mode,
-            page4_files, page4_mode,
-            page5_files, page5_mode,
-            # 提示词分组
-            prompt1_text, prompt1_mode, prompt1_inherit,
-            prompt2_text, prompt2_mode, prompt2_inherit,
-            prompt3_text, prompt3_mode, prompt3_inherit,
+            # 每页的图像和模式、提示词分组（与任务数预估共用同一份列表）
+            *estimate_inputs,
             # 公共参数
             main_key_input,
             backup_keys_input,
@@ -2280,19 +2992,26 @@ with gr.Blocks(title="Banana 图像生成", theme=gr.themes.Soft()) as demo:
             summary_output, 
             gallery_output,
             log_output
-        ]
+        ],
+        concurrency_id="submit",
+        concurrency_limit=SUBMIT_CONCURRENCY_LIMIT
     )
     
     # 刷新按钮（手动刷新）
     refresh_btn.click(
-        fn=get_current_status,
-        outputs=[summary_output, gallery_output, log_output]
+        fn=refresh_current_status,
+        outputs=[summary_output, gallery_output, log_output, status_versions, shown_gallery],
+        concurrency_id="read",
+        concurrency_limit=READ_CONCURRENCY_LIMIT
     )
     
     # 自动刷新（每2秒触发一次）
     auto_refresh.tick(
-        fn=get_current_status,
-        outputs=[summary_output, gallery_output, log_output]
+        fn=poll_current_status,
+        inputs=[status_versions],
+        outputs=[summary_output, gallery_output, log_output, status_versions, shown_gallery],
+        concurrency_id="read",
+        concurrency_limit=READ_CONCURRENCY_LIMIT
     )
     
     # 清空上传缓存
@@ -2321,79 +3040,42 @@ with gr.Blocks(title="Banana 图像生成", theme=gr.themes.Soft()) as demo:
     )
     
     # 图库选择事件：点击图像显示详情
-    def on_select_image(evt: gr.SelectData):
-        """当用户点击图库中的图像时"""
-        if evt.index is not None and all_output_files:
-            if evt.index < len(all_output_files):
-                file_path, metadata = all_output_files[evt.index]
-                
-                # 判断是单图还是多图模式
-                mode = metadata.get('mode', 'single')
-
-                if mode == 'multi-group':
-                    # 多图模式
-                    source_images = metadata.get('source_images', [])
-                    source_names = [os.path.basename(img) for img in source_images]
-                    info_text = f"""🔢 模式: 多图分组
-📸 源图像 ({len(source_images)}张):
-   {', '.join(source_names)}
-📝 提示词: {metadata.get('prompt', 'N/A')}
-🤖 模型: {metadata.get('model', 'N/A')}
-📐 宽高比: {metadata.get('aspect_ratio', 'N/A')}
-⏱️ 上传耗时: {metadata.get('upload_time', 0):.1f}秒
-⏱️ API耗时: {metadata.get('api_time', 0):.1f}秒
-⏱️ 总耗时: {metadata.get('total_time', 0):.1f}秒"""
-                elif mode == 'flexible-stage':
-                    source_images = metadata.get('source_images', [])
-                    source_names = [os.path.basename(img) for img in source_images]
-                    prompt_history = metadata.get('prompt_history', [])
-                    history_text = " → ".join(prompt_history) if prompt_history else metadata.get('prompt', 'N/A')
-                    info_text = f"""🔢 模式: 灵活分阶段
-📶 阶段: {metadata.get('stage_index', '?')}
-🔁 覆盖上一阶段: {'是' if metadata.get('replace_prompt') else '否'}
-📜 提示词链: {history_text}
-📸 源图像 ({len(source_images)}张):
-   {', '.join(source_names)}
-📝 当前提示词: {metadata.get('prompt', 'N/A')}
-🤖 模型: {metadata.get('model', 'N/A')}
-📐 宽高比: {metadata.get('aspect_ratio', 'N/A')}
-⏱️ 上传耗时: {metadata.get('upload_time', 0):.1f}秒
-⏱️ API耗时: {metadata.get('api_time', 0):.1f}秒
-⏱️ 总耗时: {metadata.get('total_time', 0):.1f}秒"""
-                else:
-                    # 单图模式
-                    info_text = f"""🔢 模式: 单图
-📸 源图像: {os.path.basename(metadata.get('source_image', 'N/A'))}
-📝 提示词: {metadata.get('prompt', 'N/A')}
-🤖 模型: {metadata.get('model', 'N/A')}
-📐 宽高比: {metadata.get('aspect_ratio', 'N/A')}
-⏱️ 上传耗时: {metadata.get('upload_time', 0):.1f}秒
-⏱️ API耗时: {metadata.get('api_time', 0):.1f}秒
-⏱️ 总耗时: {metadata.get('total_time', 0):.1f}秒"""
+    def on_select_image(gallery_items, evt: gr.SelectData):
+        """当用户点击图库中的图像时（按本会话画廊当前显示的列表解析索引）"""
+        if evt.index is not None and gallery_items:
+            if evt.index < len(gallery_items):
+                file_path = gallery_items[evt.index][0]
+                metadata = _get_image_metadata(file_path)
+                if metadata is None:
+                    return "⚠️ 未找到该图像的生成信息", None
                 
-                return info_text, file_path
+                # 同一图像的信息文本只渲染一次，缓存在元数据中
+                return metadata.info_text(), file_path
         return "未选择图像", None
     
     gallery_output.select(
         fn=on_select_image,
-        outputs=[image_info, selected_image_path]
+        inputs=[shown_gallery],
+        outputs=[image_info, selected_image_path],
+        concurrency_id="read",
+        concurrency_limit=READ_CONCURRENCY_LIMIT
     )
     
     # 重做选中图像
     def redo_selected_image(image_path, main_key, backup_keys, use_multi, workers, retries, output_dir):
         """重做选中的图像，使用相同的参数重新生成"""
-        if not image_path or image_path not in image_metadata:
+        # 获取元数据
+        metadata = _get_image_metadata(image_path)
+        if metadata is None:
             return "❌ 未选择有效图像", None, "❌ 未选择有效图像"
         
-        # 获取元数据
-        metadata = image_metadata[image_path]
-        source_images = metadata.get('source_images', [])
-        prompt = metadata.get('prompt', '')
-        model = metadata.get('model', 'flux1-dev-fp8')
-        aspect_ratio = metadata.get('aspect_ratio', '1:1')
+        source_images = metadata.source_images
+        prompt = metadata.prompt
+        model = metadata.model
+        aspect_ratio = metadata.aspect_ratio
         
         # 验证源图像
-        valid_images = [img for img in source_images if os.path.exists(img)]
+        valid_images = filter_existing_paths(source_images)
         if not valid_images:
             return "❌ 源图像文件不存在", None, "❌ 源图像文件不存在"
         
@@ -2410,21 +3092,19 @@ with gr.Blocks(title="Banana 图像生成", theme=gr.themes.Soft()) as demo:
             output_dir = output_dir.strip()
         
         try:
-            os.makedirs(output_dir, exist_ok=True)
+            _ensure_output_dir(output_dir)
         except Exception as e:
             return f"❌ 无法创建输出目录: {str(e)}", None, f"❌ 无法创建输出目录: {str(e)}"
         
         # 准备API密钥
-        all_api_keys = [main_key.strip()]
-        if use_multi and backup_keys.strip():
-            backup_list = [k.strip() for k in backup_keys.strip().split('\n') if k.strip()]
-            all_api_keys.extend(backup_list)
+        all_api_keys = build_api_key_list(main_key.strip(), backup_keys, use_multi)
         
         # 生成任务组ID
-        group_id = str(uuid.uuid4())
+        group_id = new_task_group_id()
+        register_task_group_for_cancel(group_id)
         
-        # 创建组合（单个组合，包含所有源图像）
-        combinations = [valid_images]
+        # 所有源图像作为一个"相加"页面，得到包含全部源图像的单个组合
+        valid_pages = [(tuple(valid_images), "相加")]
         stage_plan = [{
             'stage_index': 1,
             'suffixes': [prompt],
@@ -2433,23 +3113,19 @@ with gr.Blocks(title="Banana 图像生成", theme=gr.themes.Soft()) as demo:
             'inherit_stage': False
         }]
         
-        # 启动后台任务
-        thread = threading.Thread(
-            target=process_flexible_combinations_async,
-            args=(
-                group_id,
-                combinations,
-                stage_plan,
-                all_api_keys,
-                workers,
-                model,
-                aspect_ratio,
-                retries,
-                output_dir
-            ),
-            daemon=True
+        # 提交后台任务
+        submit_task_group(
+            process_flexible_combinations_async,
+            group_id,
+            valid_pages,
+            stage_plan,
+            all_api_keys,
+            workers,
+            model,
+            aspect_ratio,
+            retries,
+            output_dir
         )
-        thread.start()
         
         return (
             f"✅ 已提交重做任务 {group_id[:8]}\n📷 源图: {len(valid_images)} 张\n💬 提示词: {prompt[:50]}...\n🎨 模型: {model} | 📐 比例: {aspect_ratio}",
@@ -2471,38 +3147,45 @@ with gr.Blocks(title="Banana 图像生成", theme=gr.themes.Soft()) as demo:
         outputs=[
             summary_output,
             gallery_output, log_output
-        ]
+        ],
+        concurrency_id="submit",
+        concurrency_limit=SUBMIT_CONCURRENCY_LIMIT
     )
     
     # 重排选中图像（填充参数到表单）
+    # 重排的输出组件只构建一次，返回值个数直接由列表长度得出
+    refill_outputs = [
+        *(component for page in image_pages for component in (page['files'], page['gallery'])),
+        *prompt_components,
+        main_key_input,
+        backup_keys_input,
+        model_input,
+        aspect_ratio_input
+    ]
+    REFILL_OUTPUT_COUNT = len(refill_outputs)
+    _REFILL_NO_CHANGE = (gr.update(),) * REFILL_OUTPUT_COUNT  # 全部保持不变
+    
     def refill_selected_image(image_path):
         """将选中图像的参数填充到表单"""
-        if not image_path or image_path not in image_metadata:
-            # 返回足够数量的gr.update()
-            return [gr.update()] * 23
+        metadata = _get_image_metadata(image_path)
+        if metadata is None:
+            return _REFILL_NO_CHANGE
         
-        metadata = image_metadata[image_path]
-        source_images = metadata.get('source_images', [])
+        source_images = metadata.source_images
         
         # 验证文件存在
-        valid_images = [img for img in source_images if os.path.exists(img)]
+        valid_images = filter_existing_paths(source_images)
         
         if not valid_images:
-            return [gr.update()] * 23
+            return _REFILL_NO_CHANGE
         
-        prompt_text = metadata.get('prompt', '')
+        prompt_text = metadata.prompt
 
-        return (
-            valid_images,                             # page1_files（填充到图像1）
-            valid_images,                             # page1_gallery
-            [],                                       # page2_files（清空）
-            [],                                       # page2_gallery（清空）
-            [],                                       # page3_files（清空）
-            [],                                       # page3_gallery（清空）
-            [],                                       # page4_files（清空）
-            [],                                       # page4_gallery（清空）
-            [],                                       # page5_files（清空）
-            [],                                       # page5_gallery（清空）
+        # 源图像填充到图像1，其余各页清空（每页返回新的空列表）
+        page_values = (valid_images, gallery_thumbnails(valid_images)) + tuple(
+            value for _ in range(NUM_IMAGE_PAGES - 1) for value in ([], _EMPTY_GALLERY)
+        )
+        return page_values + (
             prompt_text,                              # prompt1_text
             "相乘",                                   # prompt1_mode
             False,                                    # prompt1_inherit
@@ -2514,131 +3197,44 @@ with gr.Blocks(title="Banana 图像生成", theme=gr.themes.Soft()) as demo:
             False,                                    # prompt3_inherit
             gr.update(),                              # main_key 保持不变
             gr.update(),                              # backup_keys 保持不变
-            metadata.get('model', 'nano-banana-fast'), # model_input
-            metadata.get('aspect_ratio', 'auto')      # aspect_ratio_input
+            metadata.model,                           # model_input
+            metadata.aspect_ratio                     # aspect_ratio_input
         )
     
     refill_selected_btn.click(
         fn=refill_selected_image,
         inputs=[selected_image_path],
-        outputs=[
-            page1_files,
-            page1_gallery,
-            page2_files,
-            page2_gallery,
-            page3_files,
-            page3_gallery,
-            page4_files,
-            page4_gallery,
-            page5_files,
-            page5_gallery,
-            prompt1_text, prompt1_mode, prompt1_inherit,
-            prompt2_text, prompt2_mode, prompt2_inherit,
-            prompt3_text, prompt3_mode, prompt3_inherit,
-            main_key_input,
-            backup_keys_input,
-            model_input,
-            aspect_ratio_input
-        ]
+        outputs=refill_outputs,
+        concurrency_id="read",
+        concurrency_limit=READ_CONCURRENCY_LIMIT
     )
     
     # 清空输出
-    def clear_all_outputs():
-        """清空所有输出结果"""
-        global all_output_files, image_metadata, task_groups
-        
-        with all_output_files_lock:
-            all_output_files.clear()
-        
-        with image_metadata_lock:
-            image_metadata.clear()
-        
-        with task_groups_lock:
-            task_groups.clear()
-        
-        return "✅ 已清空所有输出", None, ""
-    
     clear_output_btn.click(
         fn=clear_all_outputs,
-        outputs=[summary_output, gallery_output, log_output]
+        outputs=[summary_output, gallery_output, log_output, shown_gallery]
     )
     
-    gr.Markdown("""
-    ---
-    ### 💡 使用说明
-    
-    #### 🔧 两种处理模式
-    **单图模式（默认）**:
-    - 每张图像单独处理
-    - N张图 × M个提示词 = N×M个任务
-    - 适合批量处理不同图像
-    
-    **多图分组模式（新）**:
-    - 支持最多5个页面，每页独立上传图像
-    - **所有页面的图像会组合成一个数组提交给API**
-    - 例如：图像1有2张图，图像2有3张图 → API接收5张图的URL数组
-    - K个提示词 = K个任务（所有图像一起处理）
-    - 适合需要组合多张图像的场景
-    
-    #### 📝 基本流程
-    1. **上传图像**: 在5个页面中上传图像，每个页面选择组合模式（相乘/相加）
-    2. **输入提示词**: 每行一个提示词，支持多行
-    3. **配置API**: 输入主密钥，可选启用多账户模式
-    4. **调整参数**: 设置并发数、模型、宽高比、重试次数
-    5. **开始生成**: 点击"🚀 开始生成"提交任务
-    6. **查看详情**: 点击图库中的图像查看详细信息
-    7. **重做图像**: 选中图像后点击"🔄 重做此图"使用相同参数重新生成
-    8. **重排参数**: 选中图像后点击"📋 重排此图"将参数填回表单进行修改
-    
-    ### 📌 特性
-    - ✅ **灵活组合**: 每个页面独立选择"相乘"或"相加"组合模式
-    - ✅ **5个页面**: 支持5个页面，方便分批上传管理
-    - ✅ **智能计算**: 实时显示当前组合将产生的API调用次数
-    - ✅ **安全确认**: 多页面相乘时需要二次确认（防止意外大量任务）
-    - ✅ **自动刷新**: 进度每2秒自动更新（无需手动刷新）
-    - ✅ **URL缓存**: 已上传图像自动缓存，避免重复上传（💾标记）
-    - ✅ **分阶段执行**: 先并发上传所有图像，再并发调用API
-    - ✅ **多组并行**: 每次点击提交一组新任务，多组之间并行执行
-    - ✅ **实时进度**: 分别显示上传进度和API进度
-    - ✅ **多账户轮询**: 自动分配账号，突破单账号限制
-    - ✅ **自动重试**: 失败任务自动重试（默认3次）
-    - ✅ **图像元数据**: 点击图像查看提示词、耗时等详细信息
-    - ✅ **单图重做**: 针对选中图像重新生成或修改参数
-    
-    ### 📊 进度说明
-    - **上传进度**: 显示当前组图像上传完成数
-    - **API进度**: 显示当前组API调用完成数
-    - **图像画廊**: 累计显示所有已完成的图像（点击查看详情）
-    
-    ### 🔘 按钮说明
-    - **🚀 开始生成**: 提交新的任务组
-    - **🔄 刷新状态**: 手动立即刷新进度（也会自动每2秒刷新）
-    - **🗑️ 清空上传缓存**: 清空已缓存的上传URL（需要重新上传所有图像时使用）
-    - **🔄 重做此图**: 对选中图像使用相同参数重新生成
-    - **📋 重排此图**: 将选中图像的参数填回表单进行修改
-    
-    ### 🆕 灵活组合模式说明
-    - **相乘模式**: 该页面每张图单独作为一个选项，与其他页面笛卡尔积组合
-      - 示例：页面1[图1,图2](相乘) + 页面2[图a,图b](相乘) = 4个组合
-        * 组合1: [图1, 图a]
-        * 组合2: [图1, 图b]
-        * 组合3: [图2, 图a]
-        * 组合4: [图2, 图b]
-    - **相加模式**: 该页面所有图合并为一组，不增加组合数
-      - 示例：页面1[图1,图2](相乘) + 页面2[图a,图b](相加) = 2个组合
-        * 组合1: [图1, 图a, 图b]
-        * 组合2: [图2, 图a, 图b]
-    - **默认行为**: 页面1默认"相乘"，其他页面默认"相加"
-    - **任务计算**: 图像组合数 × 提示词数量 = 总API调用次数
-    """)
+    # 使用说明放在默认折叠的面板中，内容在启动时从文件读取一次
+    with gr.Accordion("💡 使用说明", open=False):
+        gr.Markdown(load_help_markdown())
 
 
 if __name__ == "__main__":
-    demo.queue()  # 启用队列以支持进度条
+    # 恢复上次运行的输出及元数据，并在后台定期快照
+    restored = load_metadata_snapshot()
+    if restored:
+        print(f"📂 已恢复 {restored} 条历史输出")
+    start_metadata_snapshotter()
+    prune_thumbnail_dir()  # 上次运行留下的缩略图不会再被引用
+    
+    # 启用队列以支持进度条；未单独分组的事件最多并发8个，
+    # 轮询/预估等只读事件与提交事件各用独立的并发组，互不排队
+    demo.queue(default_concurrency_limit=8, max_size=QUEUE_MAX_SIZE)
     demo.launch(
         server_name="0.0.0.0",
-        server_port=7861,  # 临时更改端口避免冲突
+        server_port=WEBUI_PORT,
         share=False,
-        show_error=True,
-        allowed_paths=[OUTPUT_DIR, os.path.join(os.path.dirname(__file__), "outputs")]
+        show_error=DEBUG,  # 只在调试模式下把异常详情显示到页面上
+        allowed_paths=ALLOWED_PATHS
     )